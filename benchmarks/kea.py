@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import socketserver
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+TIMESTAMP = "2024-01-01 00:00:00.000000"
+
+
+def make_config(subnets, pools, dhcp_version=4):
+    subnet_key = f"subnet{dhcp_version}"
+    config = []
+    for subnet_id in range(1, subnets + 1):
+        if dhcp_version == 4:
+            prefix = f"10.{subnet_id >> 8 & 0xFF}.{subnet_id & 0xFF}.0"
+            subnet = f"{prefix}/24"
+            pool_list = [
+                {"pool": f"{prefix[:-1]}{index * 16 + 1} - {prefix[:-1]}{index * 16 + 15}"} for index in range(pools)
+            ]
+        else:
+            prefix = f"2001:db8:{subnet_id:x}::"
+            subnet = f"{prefix}/64"
+            pool_list = [{"pool": f"{prefix}{index:x}:0/112"} for index in range(pools)]
+
+        config.append(
+            {
+                "id": subnet_id,
+                "subnet": subnet,
+                "pools": pool_list,
+                # reservations make up most of real world configurations
+                "reservations": [
+                    {"hw-address": f"02:00:00:00:{subnet_id & 0xFF:02x}:{index:02x}", "hostname": f"host{index}"}
+                    for index in range(4)
+                ],
+            }
+        )
+
+    return {f"Dhcp{dhcp_version}": {subnet_key: config}}
+
+
+def make_statistics(subnets, pools, samples, dhcp_version=4):
+    if dhcp_version == 4:
+        global_keys = ["pkt4-ack-sent", "pkt4-offer-sent", "pkt4-discover-received", "pkt4-request-received"]
+        subnet_keys = ["assigned-addresses", "total-addresses", "declined-addresses", "reclaimed-leases"]
+    else:
+        global_keys = ["pkt6-reply-sent", "pkt6-advertise-sent", "pkt6-solicit-received", "pkt6-request-received"]
+        subnet_keys = ["assigned-nas", "total-nas", "declined-addresses", "reclaimed-leases"]
+
+    def series(value):
+        return [[value, TIMESTAMP] for _ in range(samples)]
+
+    statistics = {key: series(index) for index, key in enumerate(global_keys)}
+    for subnet_id in range(1, subnets + 1):
+        for key in subnet_keys:
+            statistics[f"subnet[{subnet_id}].{key}"] = series(subnet_id)
+            for index in range(pools):
+                statistics[f"subnet[{subnet_id}].pool[{index}].{key}"] = series(index)
+
+    return statistics
+
+
+class KeaStandIn:
+    def __init__(self, subnets=1000, pools=2, samples=20, dhcp_version=4, subnet_cmds=False):
+        self.service = f"dhcp{dhcp_version}"
+        self.subnet_key = f"subnet{dhcp_version}"
+        config = make_config(subnets, pools, dhcp_version)
+        statistics = make_statistics(subnets, pools, samples, dhcp_version)
+        commands = ["config-get", "config-hash-get", "list-commands", "statistic-get-all"]
+        if subnet_cmds:
+            commands += [f"{self.subnet_key}-get", f"{self.subnet_key}-list"]
+
+        # responses are encoded once, so that serving them costs next to nothing
+        self.responses = {
+            "config-get": {"result": 0, "arguments": config},
+            "config-hash-get": {
+                "result": 0,
+                "arguments": {"hash": hashlib.sha256(json.dumps(config).encode()).hexdigest()},
+            },
+            "list-commands": {"result": 0, "arguments": commands},
+            "statistic-get-all": {"result": 0, "arguments": statistics},
+        }
+        if subnet_cmds:
+            self.responses[f"{self.subnet_key}-list"] = {
+                "result": 0,
+                "arguments": {
+                    "subnets": [
+                        {"id": subnet["id"], "subnet": subnet["subnet"]}
+                        for subnet in config[f"Dhcp{dhcp_version}"][self.subnet_key]
+                    ]
+                },
+            }
+            self.subnets = {subnet["id"]: subnet for subnet in config[f"Dhcp{dhcp_version}"][self.subnet_key]}
+        self.encoded = {command: json.dumps(response).encode() for command, response in self.responses.items()}
+        self.statistics = len(statistics)
+
+    def handle(self, request):
+        command = request.get("command")
+        if command == f"{self.subnet_key}-get" and command in self.responses["list-commands"]["arguments"]:
+            subnet = self.subnets.get(request.get("arguments", {}).get("id"))
+            if subnet is None:
+                return json.dumps({"result": 3, "text": "No subnet found"}).encode()
+            return json.dumps({"result": 0, "arguments": {self.subnet_key: [subnet]}}).encode()
+        if command in self.encoded:
+            return self.encoded[command]
+        return json.dumps({"result": 2, "text": f"'{command}' command not supported."}).encode()
+
+    def handle_agent(self, request):
+        services = request.get("service")
+        if not services:
+            # the Control Agent answers config-get itself
+            return json.dumps(
+                [
+                    {
+                        "result": 0,
+                        "arguments": {"Control-agent": {"control-sockets": {self.service: {"socket-type": "unix"}}}},
+                    }
+                ]
+            ).encode()
+
+        return b"[" + b",".join(self.handle(request) for _ in services) + b"]"
+
+
+class ControlSocketHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        request = json.loads(self.request.recv(65536))
+        self.request.sendall(self.server.kea.handle(request))
+
+
+class ControlSocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, kea):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, ControlSocketHandler)
+        self.kea = kea
+
+
+class ControlAgentHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        body = self.server.kea.handle_agent(request)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ControlAgentServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, kea):
+        super().__init__(address, ControlAgentHandler)
+        self.kea = kea
+
+
+def serve(kea, socket_path=None, port=None, address="127.0.0.1"):
+    if socket_path:
+        server = ControlSocketServer(socket_path, kea)
+    else:
+        server = ControlAgentServer((address, port), kea)
+    server.serve_forever()
+
+
+@click.command()
+@click.option("--socket", "socket_path", type=click.Path(), help="Serve a control socket at this path.")
+@click.option("--port", type=int, help="Serve a Control Agent on this port.")
+@click.option("--subnets", type=int, default=1000, show_default=True)
+@click.option("--pools", type=int, default=2, show_default=True)
+@click.option("--samples", type=int, default=20, show_default=True)
+@click.option("--dhcp-version", type=click.Choice(["4", "6"]), default="4", show_default=True)
+@click.option("--subnet-cmds", is_flag=True, help="Pretend that the subnet_cmds hook is loaded.")
+def cli(socket_path, port, subnets, pools, samples, dhcp_version, subnet_cmds):
+    if not socket_path and not port:
+        raise click.UsageError("Either --socket or --port is required.")
+
+    start_time = time.monotonic()
+    kea = KeaStandIn(subnets, pools, samples, int(dhcp_version), subnet_cmds)
+    click.echo(f"Generated {kea.statistics} statistics in {time.monotonic() - start_time:.1f}s")
+    click.echo(f"Serving on {socket_path or f'http://127.0.0.1:{port}/'}")
+    serve(kea, socket_path, port)
+
+
+if __name__ == "__main__":
+    cli()
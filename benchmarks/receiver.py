@@ -0,0 +1,177 @@
+import gzip
+import json
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+
+def decode_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def snappy_decompress(data):
+    length, offset = decode_varint(data, 0)
+    output = bytearray()
+    while offset < len(data):
+        tag = data[offset]
+        offset += 1
+        kind = tag & 3
+        if kind == 0:
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = int.from_bytes(data[offset : offset + extra], "little")
+                offset += extra
+            size += 1
+            output += data[offset : offset + size]
+            offset += size
+            continue
+
+        if kind == 1:
+            size = (tag >> 2 & 7) + 4
+            distance = (tag >> 5) << 8 | data[offset]
+            offset += 1
+        else:
+            size = (tag >> 2) + 1
+            extra = 2 if kind == 2 else 4
+            distance = int.from_bytes(data[offset : offset + extra], "little")
+            offset += extra
+        for _ in range(size):
+            output.append(output[-distance])
+
+    if len(output) != length:
+        raise ValueError(f"Expected {length} bytes, got {len(output)}")
+    return bytes(output)
+
+
+def decode_fields(data):
+    # yields the field numbers and values of a protobuf message
+    offset = 0
+    while offset < len(data):
+        key, offset = decode_varint(data, offset)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, offset = decode_varint(data, offset)
+        elif wire_type == 1:
+            value = data[offset : offset + 8]
+            offset += 8
+        elif wire_type == 2:
+            size, offset = decode_varint(data, offset)
+            value = data[offset : offset + size]
+            offset += size
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+        yield number, value
+
+
+def decode_write_request(data):
+    # returns the labels and samples of every series in a prometheus.WriteRequest
+    series = []
+    for number, timeseries in decode_fields(data):
+        if number != 1:
+            continue
+        labels = []
+        samples = []
+        for field, value in decode_fields(timeseries):
+            if field == 1:
+                label = dict(decode_fields(value))
+                labels.append((label.get(1, b"").decode(), label.get(2, b"").decode()))
+            elif field == 2:
+                sample = dict(decode_fields(value))
+                samples.append((struct.unpack("<d", sample.get(1, bytes(8)))[0], sample.get(2, 0)))
+        series.append((labels, samples))
+    return series
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.server.refuse():
+            return self.respond(503, b"refused\n")
+
+        try:
+            series = decode_write_request(snappy_decompress(body))
+        except (IndexError, ValueError) as ex:
+            return self.respond(400, f"{ex}\n".encode())
+        if any(labels != sorted(labels) or labels[0][0] != "__name__" for labels, _ in series):
+            return self.respond(400, b"labels are not sorted\n")
+
+        self.server.record("remote-write", len(body), len(series), len(self.server.connections))
+        self.respond(204)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.server.refuse():
+            return self.respond(503, b"refused\n")
+
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        series = sum(1 for line in body.decode().splitlines() if line and not line.startswith("#"))
+        self.server.record(f"pushgateway {self.path}", len(body), series, len(self.server.connections))
+        self.respond(200)
+
+    def do_GET(self):
+        self.respond(200, json.dumps(self.server.stats).encode() + b"\n")
+
+    def respond(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def setup(self):
+        super().setup()
+        self.server.connections.add(self.client_address)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReceiverServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, refuse=0):
+        super().__init__(address, ReceiverHandler)
+        self.lock = threading.Lock()
+        self.refused = refuse
+        self.connections = set()
+        self.stats = {"requests": 0, "refused": 0, "bytes": 0, "series": 0}
+
+    def refuse(self):
+        # refuses the first requests, to exercise retries
+        with self.lock:
+            if self.stats["refused"] < self.refused:
+                self.stats["refused"] += 1
+                return True
+        return False
+
+    def record(self, kind, size, series, connections):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes"] += size
+            self.stats["series"] += series
+        click.echo(f"{kind}: {series} series in {size} bytes, {connections} connections so far")
+
+
+@click.command()
+@click.option("--port", type=int, default=9091, show_default=True)
+@click.option("--refuse", type=int, default=0, help="Answer this many requests with 503 first.")
+def cli(port, refuse):
+    click.echo(f"Receiving remote-write requests and Pushgateway pushes on http://127.0.0.1:{port}/")
+    ReceiverServer(("127.0.0.1", port), refuse).serve_forever()
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,170 @@
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import click
+
+from benchmarks.kea import KeaStandIn, serve
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(check, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError("Timed out waiting for stand-in")
+
+
+def start_kea(context, transport, subnets, pools, samples, subnet_cmds, directory):
+    kea = KeaStandIn(subnets, pools, samples, subnet_cmds=subnet_cmds)
+    if transport == "socket":
+        path = os.path.join(directory, f"kea-{subnets}.sock")
+        process = context.Process(target=serve, args=(kea,), kwargs={"socket_path": path}, daemon=True)
+        process.start()
+        wait_for(lambda: os.path.exists(path))
+        return process, path, kea
+
+    port = free_port()
+    process = context.Process(target=serve, args=(kea,), kwargs={"port": port}, daemon=True)
+    process.start()
+    wait_for(lambda: socket.create_connection(("127.0.0.1", port)).close() is None)
+    return process, f"http://127.0.0.1:{port}/", kea
+
+
+def vary_values(responses):
+    varied = []
+    for dhcp_version, arguments, subnets in responses:
+        varied_arguments = {}
+        for key, data in arguments.items():
+            value, *rest = data[0]
+            if isinstance(value, (int, float)):
+                data = [[value + 1, *rest], *data[1:]]
+            varied_arguments[key] = data
+        varied.append((dhcp_version, varied_arguments, subnets))
+    return varied
+
+
+def measure_exporter(target, iterations):
+    # runs in a fresh process, so that the registry and peak RSS are its own
+    from kea_exporter.exporter import Exporter
+
+    exporter = Exporter([target], client_cert=None, client_key=None)
+    exporter.update()
+
+    update_times = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        exporter.update()
+        update_times.append(time.perf_counter() - start_time)
+
+    # Unchanged values are skipped, so iterations alternate between the
+    # responses and a copy in which every value changed, to measure parsing.
+    target = exporter.targets[0]
+    responses = exporter.fetch(target)
+    variants = [vary_values(responses), responses]
+    keys = sum(len(arguments) for _, arguments, _ in responses)
+    start_time = time.perf_counter()
+    for iteration in range(iterations):
+        for response in variants[iteration % 2]:
+            exporter.parse_metrics(*response, target=target)
+    parse_time = (time.perf_counter() - start_time) / iterations
+
+    return {
+        "update": statistics.median(update_times),
+        "parse_rate": keys / parse_time,
+        "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def measure_scrapes(target, scrapes, options):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "kea_exporter", "-a", "127.0.0.1", "-p", str(port), *options, target],
+        stdout=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}/metrics"
+    try:
+        wait_for(lambda: socket.create_connection(("127.0.0.1", port)).close() is None)
+        urllib.request.urlopen(url).read()
+
+        scrape_times = []
+        for _ in range(scrapes):
+            start_time = time.perf_counter()
+            body = urllib.request.urlopen(url).read()
+            scrape_times.append(time.perf_counter() - start_time)
+
+        with open(f"/proc/{process.pid}/status") as status:
+            rss = next(int(line.split()[1]) for line in status if line.startswith("VmHWM:")) / 1024
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {
+        "scrape": statistics.median(scrape_times),
+        "exposition_size": len(body) / 1024 / 1024,
+        "scrape_rss": rss,
+    }
+
+
+@click.command()
+@click.option(
+    "-s",
+    "--subnets",
+    type=int,
+    multiple=True,
+    default=[1000, 10000, 50000],
+    show_default=True,
+    help="Number of subnets, may be passed multiple times.",
+)
+@click.option("--pools", type=int, default=2, show_default=True, help="Number of pools per subnet.")
+@click.option("--samples", type=int, default=20, show_default=True, help="Retained samples per statistic.")
+@click.option("--transport", type=click.Choice(["socket", "http"]), default="socket", show_default=True)
+@click.option("--subnet-cmds", is_flag=True, help="Let the stand-in offer the subnet_cmds hook commands.")
+@click.option("--iterations", type=int, default=5, show_default=True, help="Timed updates per scenario.")
+@click.option("--scrapes", type=int, default=5, show_default=True, help="Timed /metrics requests per scenario.")
+@click.option("--exporter-option", "options", multiple=True, help="Extra option passed to the exporter.")
+def cli(subnets, pools, samples, transport, subnet_cmds, iterations, scrapes, options):
+    context = multiprocessing.get_context("spawn")
+
+    click.echo(
+        f"{'subnets':>8} {'stats':>8} {'payload MB':>10} {'update s':>9} {'parse keys/s':>12} "
+        f"{'RSS MB':>7} {'scrape s':>9} {'body MB':>8} {'scrape RSS MB':>13}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for count in subnets:
+            process, target, kea = start_kea(context, transport, count, pools, samples, subnet_cmds, directory)
+            try:
+                with context.Pool(1) as pool:
+                    result = pool.apply(measure_exporter, (target, iterations))
+                result.update(measure_scrapes(target, scrapes, options))
+            finally:
+                process.terminate()
+                process.join()
+
+            payload = len(kea.encoded["statistic-get-all"]) / 1024 / 1024
+            click.echo(
+                f"{count:>8} {kea.statistics:>8} {payload:>10.1f} {result['update']:>9.3f} "
+                f"{result['parse_rate']:>12.0f} {result['rss']:>7.0f} {result['scrape']:>9.3f} "
+                f"{result['exposition_size']:>8.1f} {result['scrape_rss']:>13.0f}"
+            )
+
+
+if __name__ == "__main__":
+    cli()
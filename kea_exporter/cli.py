@@ -1,23 +1,199 @@
 import sys
+import threading
 import time
+import zlib
+from urllib.parse import parse_qs
 
 import click
-from prometheus_client import REGISTRY, make_wsgi_app, start_http_server
+from prometheus_client import (
+    GC_COLLECTOR,
+    PLATFORM_COLLECTOR,
+    PROCESS_COLLECTOR,
+    REGISTRY,
+    CollectorRegistry,
+    make_wsgi_app,
+    start_http_server,
+)
+from prometheus_client.exposition import choose_encoder, gzip_accepted
 
 from kea_exporter import __project__, __version__
+from kea_exporter.debug import CAPTURE_MODES, UpdateProfiler
 from kea_exporter.exporter import Exporter
+from kea_exporter.filters import LEVELS, parse_subnet_range
+from kea_exporter.instrumentation import PUSH_BUFFERED, PUSH_REQUESTS, RENDER_DURATION
+from kea_exporter.push import PUSH_FORMATS, Pusher
+from kea_exporter.shards import ShardedExporter
+
+OPENMETRICS_EOF = b"# EOF\n"
 
 
 class Timer:
     def __init__(self):
+        self.lock = threading.Lock()
         self.reset()
 
     def reset(self):
-        self.start_time = time.time()
+        with self.lock:
+            self.start_time = time.monotonic()
 
     def time_elapsed(self):
-        now_time = time.time()
-        return now_time - self.start_time
+        now_time = time.monotonic()
+        with self.lock:
+            return now_time - self.start_time
+
+
+class SingleFlight:
+    def __init__(self, func, interval):
+        self.func = func
+        self.interval = interval
+        self.timer = Timer()
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def __call__(self):
+        generation = self.generation
+        with self.lock:
+            # another request finished an update while we were waiting, share its result
+            if generation != self.generation:
+                return
+
+            if self.timer.time_elapsed() < self.interval:
+                return
+
+            self.func()
+            self.timer.reset()
+            self.generation += 1
+
+
+class TargetsWatcher(threading.Thread):
+    def __init__(self, exporter, interval):
+        super().__init__(name="kea-exporter-targets", daemon=True)
+
+        self.exporter = exporter
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            # the watcher must keep running, whatever went wrong with this reload
+            try:
+                self.exporter.reload_targets()
+            except Exception as ex:  # noqa: BLE001
+                click.echo(f"Failed to reload targets: {ex!r}", file=sys.stderr)
+
+
+class ExpositionCache:
+    # The statistics only change with an update, so they are rendered and
+    # compressed once per update and shared by all scrapes until the next.
+    # Live collectors, like the snapshot age and the process metrics, are
+    # rendered on every scrape and appended to the cached part.
+    def __init__(self, registry, exporter, live_collectors):
+        self.registry = registry
+        self.exporter = exporter
+        self.live = Collectors(live_collectors)
+        self.lock = threading.Lock()
+        self.generation = None
+        self.bodies = {}
+        self.compressors = {}
+
+    def render(self, content_type, encoder, compressed):
+        generation = self.exporter.generation
+        with self.lock:
+            if generation != self.generation:
+                self.generation = generation
+                self.bodies = {}
+                self.compressors = {}
+
+            # concurrent scrapes wait here for the first one to render
+            body = self.bodies.get(content_type)
+            if body is None:
+                with RENDER_DURATION.time():
+                    live_names = {family.name for family in self.live.collect()}
+                    families = [family for family in self.registry.collect() if family.name not in live_names]
+                    body = encoder(Snapshot(families))
+                    # OpenMetrics ends with an EOF marker, which has to follow the live part
+                    if body.endswith(OPENMETRICS_EOF):
+                        body = body[: -len(OPENMETRICS_EOF)]
+                    self.bodies[content_type] = body
+
+            if compressed:
+                # the compressor holds the state after the cached part, a copy of it only compresses the live part
+                if content_type not in self.compressors:
+                    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+                    self.compressors[content_type] = (compressor.compress(body), compressor)
+                prefix, compressor = self.compressors[content_type]
+                compressor = compressor.copy()
+
+        with RENDER_DURATION.time():
+            live = encoder(self.live)
+        if not compressed:
+            return body + live
+        return prefix + compressor.compress(live) + compressor.flush()
+
+    def __call__(self, environ, start_response):
+        encoder, content_type = choose_encoder(environ.get("HTTP_ACCEPT"))
+        compressed = gzip_accepted(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        body = self.render(content_type, encoder, compressed)
+
+        headers = [("Content-Type", content_type), ("Content-Length", str(len(body)))]
+        if compressed:
+            headers.append(("Content-Encoding", "gzip"))
+        start_response("200 OK", headers)
+        return [body]
+
+
+class Snapshot:
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+class Collectors:
+    def __init__(self, collectors):
+        self.collectors = collectors
+
+    def collect(self):
+        for collector in self.collectors:
+            yield from collector.collect()
+
+
+class Poller(threading.Thread):
+    def __init__(self, exporter, interval):
+        super().__init__(name="kea-exporter-poller", daemon=True)
+
+        self.exporter = exporter
+        self.interval = interval
+
+    def run(self):
+        while True:
+            start_time = time.monotonic()
+            # the poller must keep running, whatever went wrong with this update
+            try:
+                self.exporter.update()
+            except Exception as ex:  # noqa: BLE001
+                click.echo(f"Failed to update metrics: {ex!r}", file=sys.stderr)
+            time.sleep(max(0, self.interval - (time.monotonic() - start_time)))
+
+
+def parse_push_labels(ctx, param, value):
+    labels = {}
+    for label in value:
+        name, sep, label_value = label.partition("=")
+        if not sep or not name:
+            raise click.BadParameter(f"Expected name=value: {label}")
+        labels[name] = label_value
+    return labels
+
+
+def validate_subnet_ranges(ctx, param, value):
+    for subnet_range in value:
+        try:
+            parse_subnet_range(subnet_range)
+        except ValueError as ex:
+            raise click.BadParameter(str(ex)) from None
+    return value
 
 
 @click.command()
@@ -45,6 +221,133 @@ class Timer:
     default=0,
     help="Minimal interval between two queries to Kea in seconds.",
 )
+@click.option(
+    "-b",
+    "--background",
+    envvar="BACKGROUND",
+    is_flag=True,
+    help="Query Kea in the background every interval and serve the latest snapshot.",
+)
+@click.option(
+    "--collector",
+    envvar="COLLECTOR",
+    is_flag=True,
+    help="Export only the series of the latest update, so that series of removed subnets disappear.",
+)
+@click.option(
+    "--kea-timestamps",
+    envvar="KEA_TIMESTAMPS",
+    is_flag=True,
+    help="Export samples with the time Kea recorded them, requires --collector.",
+)
+@click.option(
+    "--aggregates",
+    envvar="AGGREGATES",
+    is_flag=True,
+    help="Export utilization ratios per pool and subnet, and sums and ratios per shared network.",
+)
+@click.option(
+    "--include-metric",
+    "include_metrics",
+    envvar="INCLUDE_METRICS",
+    multiple=True,
+    help="Only export metrics whose name matches this glob pattern, may be passed multiple times.",
+)
+@click.option(
+    "--exclude-metric",
+    "exclude_metrics",
+    envvar="EXCLUDE_METRICS",
+    multiple=True,
+    help="Do not export metrics whose name matches this glob pattern, may be passed multiple times.",
+)
+@click.option(
+    "--include-subnet",
+    "include_subnets",
+    envvar="INCLUDE_SUBNETS",
+    multiple=True,
+    callback=validate_subnet_ranges,
+    help="Only export series of subnet IDs in this range, like 100-199, may be passed multiple times.",
+)
+@click.option(
+    "--exclude-subnet",
+    "exclude_subnets",
+    envvar="EXCLUDE_SUBNETS",
+    multiple=True,
+    callback=validate_subnet_ranges,
+    help="Do not export series of subnet IDs in this range, like 100-199, may be passed multiple times.",
+)
+@click.option(
+    "--exclude-level",
+    "exclude_levels",
+    envvar="EXCLUDE_LEVELS",
+    multiple=True,
+    type=click.Choice(LEVELS),
+    help="Do not export statistics of this level, may be passed multiple times.",
+)
+@click.option(
+    "-t",
+    "--timeout",
+    envvar="TIMEOUT",
+    type=float,
+    default=10,
+    help="Timeout for a single query to a target in seconds.",
+)
+@click.option(
+    "--connect-timeout",
+    envvar="CONNECT_TIMEOUT",
+    type=float,
+    help="Timeout for connecting to a target in seconds, defaults to the query timeout.",
+)
+@click.option(
+    "--max-response-size",
+    envvar="MAX_RESPONSE_SIZE",
+    type=click.IntRange(min=0),
+    default=256,
+    help="Maximum size of a response from a target in MiB, 0 disables the limit.",
+)
+@click.option(
+    "--scrape-timeout",
+    envvar="SCRAPE_TIMEOUT",
+    type=float,
+    default=0,
+    help="Maximum time in seconds to wait for all targets, 0 disables the deadline.",
+)
+@click.option(
+    "-c",
+    "--concurrency",
+    envvar="CONCURRENCY",
+    type=int,
+    default=8,
+    help="Number of targets that are queried concurrently.",
+)
+@click.option(
+    "--failure-threshold",
+    envvar="FAILURE_THRESHOLD",
+    type=click.IntRange(min=1),
+    default=3,
+    help="Number of failed updates in a row after which a target is skipped for a cooldown.",
+)
+@click.option(
+    "--max-backoff",
+    envvar="MAX_BACKOFF",
+    type=float,
+    default=300,
+    help="Maximum cooldown in seconds of a target that keeps failing.",
+)
+@click.option(
+    "--processes",
+    envvar="PROCESSES",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of worker processes that the targets are split across.",
+)
+@click.option(
+    "--config-max-age",
+    envvar="CONFIG_MAX_AGE",
+    type=int,
+    default=0,
+    help="Maximum age of the cached subnet configuration in seconds, when Kea does not support config-hash-get.",
+)
 @click.option(
     "--client-cert",
     envvar="CLIENT_CERT",
@@ -59,27 +362,213 @@ class Timer:
     help="Path to client key used in HTTP requests",
     required=False,
 )
-@click.argument("targets", envvar="TARGETS", nargs=-1, required=True)
+@click.option(
+    "--http-compression/--no-http-compression",
+    envvar="HTTP_COMPRESSION",
+    default=True,
+    help="Request gzip compressed responses from HTTP targets.",
+)
+@click.option(
+    "--kea-config",
+    "kea_configs",
+    envvar="KEA_CONFIGS",
+    multiple=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Path to a Kea configuration with the subnets of lease file targets, may be passed multiple times.",
+)
+@click.option(
+    "--targets-file",
+    envvar="TARGETS_FILE",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Path to a JSON or YAML file in the Prometheus file_sd format, that is watched for targets.",
+)
+@click.option(
+    "--targets-file-interval",
+    envvar="TARGETS_FILE_INTERVAL",
+    type=float,
+    default=5,
+    help="Interval between two checks of the targets file for changes in seconds.",
+)
+@click.option(
+    "--push-url",
+    envvar="PUSH_URL",
+    help="Push metrics every interval to this remote-write endpoint or Pushgateway.",
+)
+@click.option(
+    "--push-format",
+    envvar="PUSH_FORMAT",
+    type=click.Choice(PUSH_FORMATS),
+    default="remote-write",
+    help="Protocol of the push URL.",
+)
+@click.option(
+    "--push-label",
+    "push_labels",
+    envvar="PUSH_LABELS",
+    multiple=True,
+    callback=parse_push_labels,
+    help="Label like instance=dhcp1 added to pushed metrics, may be passed multiple times.",
+)
+@click.option(
+    "--push-batch-size",
+    envvar="PUSH_BATCH_SIZE",
+    type=click.IntRange(min=1),
+    default=2000,
+    help="Maximum number of series per remote-write request.",
+)
+@click.option(
+    "--push-buffer",
+    envvar="PUSH_BUFFER",
+    type=click.IntRange(min=1),
+    default=100,
+    help="Maximum number of remote-write requests kept for retrying.",
+)
+@click.option(
+    "--debug-endpoints",
+    envvar="DEBUG_ENDPOINTS",
+    is_flag=True,
+    help="Serve /debug/profile, that profiles the next updates.",
+)
+@click.argument("targets", envvar="TARGETS", nargs=-1)
 @click.version_option(prog_name=__project__, version=__version__)
-def cli(port, address, interval, **kwargs):
-    exporter = Exporter(**kwargs)
+def cli(
+    port,
+    address,
+    interval,
+    background,
+    targets_file_interval,
+    push_url,
+    push_format,
+    push_labels,
+    push_batch_size,
+    push_buffer,
+    processes,
+    debug_endpoints,
+    **kwargs,
+):
+    if push_url and interval <= 0:
+        raise click.UsageError("Push mode requires an interval greater than 0.")
+    if push_url and push_format == "pushgateway" and kwargs["kea_timestamps"]:
+        raise click.UsageError("The Pushgateway does not accept Kea timestamps.")
+    if background and interval <= 0:
+        raise click.UsageError("Background mode requires an interval greater than 0.")
+    if debug_endpoints and processes > 1:
+        # the workers run the updates, which the profiler of the main process does not see
+        raise click.UsageError("Debug endpoints cannot profile worker processes, use --processes 1.")
+    if kwargs["kea_timestamps"] and not kwargs["collector"]:
+        raise click.UsageError("Kea timestamps require --collector.")
+    if not kwargs["targets"] and not kwargs["targets_file"]:
+        raise click.UsageError("Pass at least one target or a targets file.")
 
-    if not exporter.targets:
+    if processes > 1:
+        exporter = ShardedExporter(processes=processes, **kwargs)
+    else:
+        exporter = Exporter(**kwargs)
+
+    # the targets file may legitimately list no targets yet
+    if not exporter.targets and not exporter.targets_file:
         sys.exit(1)
 
+    # wraps the update method, before the poller or pusher get hold of it
+    profiler = UpdateProfiler(exporter) if debug_endpoints else None
+
+    if exporter.targets_file:
+        TargetsWatcher(exporter, targets_file_interval).start()
+
     httpd, _ = start_http_server(port, address)
 
-    t = Timer()
+    update = SingleFlight(exporter.update, interval)
+
+    if push_url:
+        # pushing replaces the background poller, scrapes serve the latest update
+        background = True
+        Pusher(
+            exporter,
+            REGISTRY,
+            push_url,
+            interval,
+            push_format,
+            push_labels,
+            push_batch_size,
+            push_buffer,
+            kwargs["timeout"],
+        ).start()
+    elif background:
+        Poller(exporter, interval).start()
+
+    def probe_app(environ, start_response):
+        target = parse_qs(environ.get("QUERY_STRING", "")).get("target", [None])[0]
+        if not target:
+            start_response("400 Bad Request", [("Content-Type", "text/plain")])
+            return [b"Target parameter is missing\n"]
+
+        try:
+            families = exporter.probe(target)
+        except KeyError:
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [f"Unknown target {target}\n".encode()]
+
+        registry = CollectorRegistry(auto_describe=False)
+        registry.register(Snapshot(families))
+        with RENDER_DURATION.time():
+            return make_wsgi_app(registry, False)(environ, start_response)
+
+    def debug_app(environ, start_response):
+        query = parse_qs(environ.get("QUERY_STRING", ""))
+        mode = query.get("mode", ["cprofile"])[0]
+        try:
+            updates = int(query.get("updates", ["1"])[0])
+            sample_interval = float(query.get("interval", ["0.005"])[0])
+            limit = int(query.get("limit", ["25"])[0])
+        except ValueError as ex:
+            start_response("400 Bad Request", [("Content-Type", "text/plain")])
+            return [f"{ex}\n".encode()]
+        if mode not in CAPTURE_MODES or not 1 <= updates <= 100 or sample_interval <= 0:
+            start_response("400 Bad Request", [("Content-Type", "text/plain")])
+            modes = ", ".join(CAPTURE_MODES)
+            return [f"Expected mode in {modes}, updates from 1 to 100 and a positive interval\n".encode()]
+
+        # without a poller or pusher the updates are run for the request
+        capture = profiler.run(mode, updates, trigger=not background, interval=sample_interval, limit=limit)
+        if capture is None:
+            start_response("409 Conflict", [("Content-Type", "text/plain")])
+            return [b"Another capture is running\n"]
+
+        body = capture.result()
+        start_response(
+            "200 OK",
+            [
+                ("Content-Type", capture.content_type),
+                ("Content-Disposition", f'attachment; filename="{capture.filename}"'),
+                ("Content-Length", str(len(body))),
+            ],
+        )
+        return [body]
 
     def local_wsgi_app(registry):
         func = make_wsgi_app(registry, False)
+        exposition = ExpositionCache(
+            registry,
+            exporter,
+            [PROCESS_COLLECTOR, PLATFORM_COLLECTOR, GC_COLLECTOR, RENDER_DURATION, PUSH_REQUESTS, PUSH_BUFFERED]
+            + exporter.live_collectors,
+        )
 
         def app(environ, start_response):
-            if t.time_elapsed() >= interval:
-                exporter.update()
-                t.reset()
-            output_array = func(environ, start_response)
-            return output_array
+            if environ.get("PATH_INFO") == "/probe":
+                return probe_app(environ, start_response)
+            if debug_endpoints and environ.get("PATH_INFO") == "/debug/profile":
+                return debug_app(environ, start_response)
+
+            if not background:
+                update()
+
+            # filtered requests and the favicon are not cached
+            if environ.get("QUERY_STRING") or environ.get("PATH_INFO") == "/favicon.ico":
+                with RENDER_DURATION.time():
+                    return func(environ, start_response)
+
+            return exposition(environ, start_response)
 
         return app
 
@@ -0,0 +1,191 @@
+import cProfile
+import marshal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+CAPTURE_MODES = ("cprofile", "sampling", "tracemalloc")
+
+
+class CProfileCapture:
+    # Before Python 3.12 only the thread that runs the update is profiled,
+    # which includes parsing, but not the queries of the worker threads.
+    # Since then all threads are profiled, by one profiler at a time.
+    content_type = "application/octet-stream"
+    filename = "kea-exporter.pstats"
+
+    def __init__(self, **kwargs):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def result(self):
+        # the format that pstats.Stats() loads from a file
+        self.profile.create_stats()
+        return marshal.dumps(self.profile.stats)
+
+
+class SamplingCapture:
+    # Samples the stacks of the update thread and the query threads, and
+    # writes them as collapsed stacks, as read by flamegraph.pl or speedscope.
+    content_type = "text/plain; charset=utf-8"
+    filename = "kea-exporter.collapsed"
+
+    def __init__(self, interval=0.005, **kwargs):
+        self.interval = interval
+        self.stacks = Counter()
+        self.update_thread = None
+        self.sampler = None
+        self.active = threading.Event()
+        self.done = threading.Event()
+
+    def start(self):
+        self.update_thread = threading.get_ident()
+        if self.sampler is None:
+            self.sampler = threading.Thread(target=self.run, name="kea-exporter-sampler", daemon=True)
+            self.sampler.start()
+        self.active.set()
+
+    def stop(self):
+        self.active.clear()
+
+    def run(self):
+        while not self.done.is_set():
+            if not self.active.wait(0.1):
+                continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, "")
+                if ident != self.update_thread and not name.startswith("kea-exporter_"):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(name)
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def result(self):
+        self.done.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()).encode()
+
+
+class TracemallocCapture:
+    # Reports the peak of the traced memory during every update, which covers
+    # the transient allocations of decoding and parsing, and the lines whose
+    # allocations grew the most from the start of the first to the end of
+    # the last update, e.g. by snapshots and key plans.
+    content_type = "text/plain; charset=utf-8"
+    filename = "kea-exporter-allocations.txt"
+
+    def __init__(self, limit=25, **kwargs):
+        self.limit = limit
+        self.before = None
+        self.after = None
+        self.peaks = []
+        self.start_size = 0
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.before is None:
+            self.before = tracemalloc.take_snapshot()
+        # tracemalloc.reset_peak() is only available since Python 3.9
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        self.start_size = tracemalloc.get_traced_memory()[0]
+
+    def stop(self):
+        self.after = tracemalloc.take_snapshot()
+        self.peaks.append((self.start_size, tracemalloc.get_traced_memory()[1]))
+
+    def result(self):
+        tracemalloc.stop()
+        if self.after is None:
+            return b""
+
+        lines = [
+            f"Update {index}: peak of {peak / 1024:.1f} KiB traced, {(peak - size) / 1024:.1f} KiB above its start"
+            for index, (size, peak) in enumerate(self.peaks, 1)
+        ]
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        statistics = self.after.filter_traces(filters).compare_to(self.before.filter_traces(filters), "lineno")
+        lines.append(f"Top {self.limit} lines by the size they still held after the updates, compared to before:")
+        lines.extend(str(statistic) for statistic in statistics[: self.limit])
+        return ("\n".join(lines) + "\n").encode()
+
+
+class UpdateProfiler:
+    # Wraps Exporter.update(), so that the next updates are captured, no
+    # matter whether they are run by scrapes, the poller or the pusher.
+    def __init__(self, exporter):
+        self.update_lock = exporter.update_lock
+        self._update = exporter._update
+        exporter.update = self.profiled_update
+
+        # one capture at a time
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.capture = None
+        self.remaining = 0
+
+    def profiled_update(self):
+        # The capture is started and stopped under the lock of the update, so
+        # that overlapping updates are captured one after another.
+        with self.update_lock:
+            with self.condition:
+                capture = self.capture
+            if capture is None:
+                return self._update()
+
+            capture.start()
+            try:
+                return self._update()
+            finally:
+                capture.stop()
+                with self.condition:
+                    self.remaining -= 1
+                    if self.remaining <= 0:
+                        self.capture = None
+                    self.condition.notify_all()
+
+    def run(self, mode, updates=1, timeout=300, trigger=False, **kwargs):
+        # Captures the next updates and returns the capture, or None if
+        # another capture is running. With trigger the updates are run
+        # right away, instead of waiting for the schedule.
+        if not self.lock.acquire(blocking=False):
+            return None
+
+        try:
+            if mode == "cprofile":
+                capture = CProfileCapture(**kwargs)
+            elif mode == "sampling":
+                capture = SamplingCapture(**kwargs)
+            else:
+                capture = TracemallocCapture(**kwargs)
+
+            with self.condition:
+                self.capture = capture
+                self.remaining = updates
+
+            if trigger:
+                for _ in range(updates):
+                    self.profiled_update()
+
+            with self.condition:
+                self.condition.wait_for(lambda: self.capture is None, timeout)
+                self.capture = None
+
+            return capture
+        finally:
+            self.lock.release()
@@ -0,0 +1,361 @@
+import codecs
+import json
+import re
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# initial size of receive buffers, and the size of chunks that are decoded incrementally
+BUFFER_SIZE = 65536
+# grown buffers beyond this size are not kept, only few queries like config-get return that much
+BUFFER_KEEP_SIZE = 1 << 20
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+MEMBER = re.compile(r'[ \t\n\r]*"((?:[^"\\]|\\.)*)"[ \t\n\r]*:[ \t\n\r]*')
+# The usual sample of a number and a timestamp. Strings may contain brackets,
+# so samples that do not match, e.g. with string values, are decoded by the
+# JSONDecoder instead of being split at the first bracket.
+SAMPLE_PATTERN = r'\[[^\[\]"]*"[^"\[\]\\]*"[ \t\n\r]*\]'
+SAMPLE = re.compile(SAMPLE_PATTERN)
+SAMPLE_SEPARATOR = re.compile(r"[ \t\n\r]*,[ \t\n\r]*")
+NEXT_SAMPLE = re.compile(r"[ \t\n\r]*,[ \t\n\r]*" + SAMPLE_PATTERN)
+REMAINING_SAMPLES = re.compile(r"(?:[ \t\n\r]*,[ \t\n\r]*" + SAMPLE_PATTERN + r")*[ \t\n\r]*\]")
+# a complete statistic and the following separator, with the first sample
+# split into integer value and timestamp where possible
+STATISTIC = re.compile(
+    r'[ \t\n\r]*"([^"\\]*)"[ \t\n\r]*:[ \t\n\r]*\[[ \t\n\r]*'
+    r'(?:\[[ \t\n\r]*(-?\d+)[ \t\n\r]*,[ \t\n\r]*"([^"\\]*)"[ \t\n\r]*\]|(' + SAMPLE_PATTERN + r"))"
+    r"(?:[ \t\n\r]*,[ \t\n\r]*" + SAMPLE_PATTERN + r")*[ \t\n\r]*\][ \t\n\r]*([,}])"
+)
+
+
+def loads(data):
+    # Decodes JSON from bytes, a bytearray or a memoryview, with orjson when it
+    # is installed, which parses large responses several times faster.
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(str(data, "utf-8"))
+
+
+def check_size(size, limit):
+    if limit and size > limit:
+        raise ValueError(f"Response exceeds the maximum size of {limit} bytes")
+
+
+class ResponseBuffer:
+    # A receive buffer that is reused across queries and grows as needed, so
+    # that responses are read without allocating and joining chunks, and are
+    # decoded from bytes without an intermediate string.
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.size = 0
+
+    def grow(self, size):
+        # at least doubles the buffer, so that growing it is amortized
+        self.buffer.extend(bytes(max(size, len(self.buffer))))
+
+    def recv_into(self, sock):
+        # returns the number of bytes received, which is 0 at the end of the response
+        if self.size == len(self.buffer):
+            self.grow(len(self.buffer))
+        with memoryview(self.buffer)[self.size :] as view:
+            received = sock.recv_into(view)
+        self.size += received
+        check_size(self.size, self.limit)
+        return received
+
+    def write(self, data):
+        end = self.size + len(data)
+        check_size(end, self.limit)
+        if end > len(self.buffer):
+            self.grow(end - len(self.buffer))
+        self.buffer[self.size : end] = data
+        self.size = end
+
+    def decode(self):
+        try:
+            with memoryview(self.buffer)[: self.size] as view:
+                return loads(view)
+        finally:
+            self.clear()
+
+    def clear(self):
+        self.size = 0
+        if len(self.buffer) > BUFFER_KEEP_SIZE:
+            self.buffer = bytearray(BUFFER_SIZE)
+
+
+# Incrementally decodes a statistic-get-all response. Kea returns all retained
+# samples of every statistic, newest first, of which only the first one is kept
+# while the others are skipped without being decoded. Responses from the
+# Control Agent, which wrap one response per service in a list, are supported
+# as well.
+class StatisticsDecoder:
+    def __init__(self, limit=0):
+        self.limit = limit
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._state = self._start
+
+        self._responses = None
+        self._response = None
+        self._key = None
+        self._statistics = None
+        self._statistic = None
+        self._result = None
+
+        # bytes fed and time spent decoding them, for instrumentation
+        self.size = 0
+        self.duration = 0.0
+
+    def feed(self, data):
+        start_time = time.perf_counter()
+        self.size += len(data)
+        check_size(self.size, self.limit)
+        text = self._decoder.decode(data)
+        if self._pos:
+            self._buffer = self._buffer[self._pos :] + text
+            self._pos = 0
+        else:
+            self._buffer += text
+        self._run()
+        self.duration += time.perf_counter() - start_time
+
+    def close(self):
+        start_time = time.perf_counter()
+        self._buffer = self._buffer[self._pos :] + self._decoder.decode(b"", final=True)
+        self._pos = 0
+        self._eof = True
+        self._run()
+        self.duration += time.perf_counter() - start_time
+
+        if self._state is not None:
+            raise ValueError("Incomplete statistics response")
+        if self._peek() is not None:
+            raise ValueError("Trailing data after statistics response")
+
+        return self._result
+
+    def _run(self):
+        while self._state is not None:
+            state = self._state()
+            if state is False:
+                if self._eof:
+                    raise ValueError("Invalid statistics response")
+                return
+            self._state = state
+
+    def _peek(self):
+        self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+        if self._pos < len(self._buffer):
+            return self._buffer[self._pos]
+        return None
+
+    def _decode_key(self, key):
+        if "\\" in key:
+            return json.loads(f'"{key}"')
+        return key
+
+    def _start(self):
+        char = self._peek()
+        if char == "[":
+            self._pos += 1
+            self._responses = []
+            return self._next_response
+        if char == "{":
+            return self._response_start
+        return False
+
+    def _next_response(self):
+        char = self._peek()
+        if char == "{":
+            return self._response_start
+        if char == "]" and not self._responses:
+            self._pos += 1
+            self._result = self._responses
+            return None
+        return False
+
+    def _response_start(self):
+        self._pos += 1
+        self._response = {}
+        return self._first_member
+
+    def _first_member(self):
+        char = self._peek()
+        if char == "}":
+            self._pos += 1
+            return self._response_end()
+        if char is None:
+            return False
+        return self._member
+
+    def _member(self):
+        match = MEMBER.match(self._buffer, self._pos)
+        if not match:
+            return False
+        self._pos = match.end()
+        self._key = self._decode_key(match.group(1))
+        return self._value
+
+    def _value(self):
+        char = self._peek()
+        if char is None:
+            return False
+
+        if self._key == "arguments" and char == "{":
+            self._pos += 1
+            self._statistics = {}
+            return self._first_statistic
+
+        try:
+            value, end = self._json.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            return False
+        if end == len(self._buffer) and not self._eof:
+            # numbers might continue in the next chunk
+            return False
+
+        self._pos = end
+        self._response[self._key] = value
+        return self._member_separator
+
+    def _member_separator(self):
+        char = self._peek()
+        if char == ",":
+            self._pos += 1
+            return self._member
+        if char == "}":
+            self._pos += 1
+            return self._response_end()
+        return False
+
+    def _response_end(self):
+        if self._responses is None:
+            self._result = self._response
+            return None
+
+        self._responses.append(self._response)
+        return self._response_separator
+
+    def _response_separator(self):
+        char = self._peek()
+        if char == ",":
+            self._pos += 1
+            return self._next_response
+        if char == "]":
+            self._pos += 1
+            self._result = self._responses
+            return None
+        return False
+
+    def _first_statistic(self):
+        char = self._peek()
+        if char == "}":
+            self._pos += 1
+            return self._statistics_end()
+        if char is None:
+            return False
+        return self._statistic_start
+
+    def _statistic_start(self):
+        # fast path for statistics that were received completely
+        buffer = self._buffer
+        statistics = self._statistics
+        match = STATISTIC.match(buffer, self._pos)
+        while match:
+            key, value, timestamp, sample, separator = match.groups()
+            if value is not None:
+                statistics[key] = [[int(value), timestamp]]
+            else:
+                statistics[key] = [json.loads(sample)]
+
+            self._pos = match.end()
+            if separator == "}":
+                return self._statistics_end()
+            match = STATISTIC.match(buffer, self._pos)
+
+        match = MEMBER.match(self._buffer, self._pos)
+        if not match or not self._buffer.startswith("[", match.end()):
+            return False
+        self._pos = match.end() + 1
+        self._statistic = self._decode_key(match.group(1))
+        return self._first_sample
+
+    def _first_sample(self):
+        char = self._peek()
+        if char == "]":
+            self._pos += 1
+            self._statistics[self._statistic] = []
+            return self._statistic_separator
+
+        match = SAMPLE.match(self._buffer, self._pos)
+        if match:
+            self._pos = match.end()
+            self._statistics[self._statistic] = [json.loads(match.group(0))]
+            return self._remaining_samples
+
+        sample = self._decode_sample(self._pos)
+        if sample is None:
+            return False
+        self._statistics[self._statistic] = [sample[0]]
+        self._pos = sample[1]
+        return self._remaining_samples
+
+    def _remaining_samples(self):
+        match = REMAINING_SAMPLES.match(self._buffer, self._pos)
+        if match:
+            self._pos = match.end()
+            return self._statistic_separator
+
+        # skip the samples received so far and wait for the rest
+        match = NEXT_SAMPLE.match(self._buffer, self._pos)
+        while match:
+            self._pos = match.end()
+            match = NEXT_SAMPLE.match(self._buffer, self._pos)
+
+        char = self._peek()
+        if char == "]":
+            self._pos += 1
+            return self._statistic_separator
+        if char != ",":
+            return False
+
+        sample = self._decode_sample(SAMPLE_SEPARATOR.match(self._buffer, self._pos).end())
+        if sample is None:
+            return False
+        self._pos = sample[1]
+        return self._remaining_samples
+
+    def _decode_sample(self, pos):
+        # returns a sample that the patterns do not match and its end, or None until it was received completely
+        try:
+            value, end = self._json.raw_decode(self._buffer, pos)
+        except json.JSONDecodeError:
+            return None
+        if end == len(self._buffer) and not self._eof:
+            # numbers might continue in the next chunk
+            return None
+        return value, end
+
+    def _statistic_separator(self):
+        char = self._peek()
+        if char == ",":
+            self._pos += 1
+            return self._statistic_start
+        if char == "}":
+            self._pos += 1
+            return self._statistics_end()
+        return False
+
+    def _statistics_end(self):
+        self._response[self._key] = self._statistics
+        self._statistics = None
+        return self._member_separator
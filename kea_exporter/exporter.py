@@ -1,12 +1,31 @@
 import re
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from datetime import datetime
 from urllib.parse import urlparse
 
 import click
-from prometheus_client import Gauge
+from prometheus_client import REGISTRY, Gauge
+from prometheus_client.core import GaugeMetricFamily
 
 from kea_exporter import DHCPVersion
+from kea_exporter.filters import SeriesFilter
+from kea_exporter.health import TargetHealth
 from kea_exporter.http import KeaHTTPClient
+from kea_exporter.instrumentation import (
+    CHANGED_SERIES,
+    PHASE_DURATION,
+    STATISTICS,
+    TARGET_FAILURES,
+    TARGET_LAST_SUCCESS,
+    TARGET_METRICS,
+    TARGET_UP,
+    remove_target_metrics,
+)
+from kea_exporter.memfile import KeaMemfileClient
+from kea_exporter.targets import TargetsFile
 from kea_exporter.uds import KeaSocketClient
 
 
@@ -15,24 +34,72 @@ class Exporter:
         r"^subnet\[(?P<subnet_id>[\d]+)\]\.(pool\[(?P<pool_index>[\d]+)\]\.(?P<pool_metric>[\w-]+)|(?P<subnet_metric>[\w-]+))$"
     )
 
-    def __init__(self, targets, **kwargs):
+    def __init__(
+        self,
+        targets,
+        concurrency=8,
+        scrape_timeout=None,
+        collector=False,
+        kea_timestamps=False,
+        aggregates=False,
+        include_metrics=(),
+        exclude_metrics=(),
+        include_subnets=(),
+        exclude_subnets=(),
+        exclude_levels=(),
+        targets_file=None,
+        failure_threshold=3,
+        max_backoff=300,
+        **kwargs,
+    ):
         # prometheus
         self.prefix = "kea"
+
+        # In collector mode the gauges below only serve as metric definitions,
+        # samples are kept per target and exported through collect().
+        self.collector = collector
+        self.registry = None if collector else REGISTRY
+        # samples carry Kea's timestamp when they changed since the last update
+        self.kea_timestamps = kea_timestamps
+        # utilization ratios and shared network sums computed from the statistics, see get_aggregate_plans()
+        self.aggregates = aggregates
+        # levels only apply to statistics, so that pool ratios remain without pool statistics
+        self.series_filter = SeriesFilter(
+            include_metrics, exclude_metrics, include_subnets, exclude_subnets, exclude_levels
+        )
+        self.snapshots = {}
         self.prefix_dhcp4 = f"{self.prefix}_dhcp4"
         self.prefix_dhcp6 = f"{self.prefix}_dhcp6"
 
         self.metrics_dhcp4 = None
         self.metrics_dhcp4_map = None
+        self.aggregates_dhcp4 = None
         self.metrics_dhcp4_global_ignore = None
         self.metrics_dhcp4_subnet_ignore = None
         self.setup_dhcp4_metrics()
 
         self.metrics_dhcp6 = None
         self.metrics_dhcp6_map = None
+        self.aggregates_dhcp6 = None
         self.metrics_dhcp6_global_ignore = None
         self.metrics_dhcp6_subnet_ignore = None
         self.setup_dhcp6_metrics()
 
+        self.update_lock = threading.Lock()
+        self.last_update = None
+        # changes whenever the exported series may have changed
+        self.generation = 0
+        self.snapshot_age = Gauge(
+            f"{self.prefix}_exporter_snapshot_age_seconds",
+            "Seconds since the exported statistics were last queried from Kea",
+        )
+        self.snapshot_age.set_function(self.get_snapshot_age)
+        # metrics that change between updates, e.g. through probes, are not cached with the exposition
+        self.live_collectors = [self.snapshot_age, *TARGET_METRICS]
+
+        # resolved label children, or series when collecting samples, per stat key, see get_key_plans()
+        self.key_plans = {}
+
         # track unhandled metric keys, to notify only once
         self.unhandled_metrics = set()
 
@@ -42,37 +109,234 @@ class Exporter:
             DHCPVersion.DHCP6: [],
         }
 
+        # targets from the command line are always queried, those from the
+        # targets file are added and removed whenever the file changes
+        self.client_kwargs = kwargs
+        self.static_targets = list(targets)
+        self.targets_file = TargetsFile(targets_file) if targets_file else None
         self.targets = []
-        for target in targets:
-            url = urlparse(target)
-            client = None
-            try:
-                if url.scheme:
-                    client = KeaHTTPClient(target, **kwargs)
-                elif url.path:
-                    client = KeaSocketClient(target, **kwargs)
-                else:
-                    click.echo(f"Unable to parse target argument: {target}")
-                    continue
-            except OSError as ex:
-                click.echo(ex)
+        self.target_locks = {}
+        # targets that keep failing are skipped for a growing cooldown
+        self.failure_threshold = failure_threshold
+        self.max_backoff = max_backoff
+        self.target_health = {}
+        self.set_targets(self.static_targets + (self.read_targets_file() or []))
+
+        if self.collector:
+            REGISTRY.register(self)
+
+        # query targets concurrently, but parse their responses one at a time,
+        # worker threads are only started once there are enough targets
+        self.scrape_timeout = scrape_timeout or None
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, concurrency),
+            thread_name_prefix="kea-exporter",
+        )
+
+    def create_client(self, target):
+        # clients connect on their first update, so that targets that are
+        # down at startup are retried instead of dropped
+        url = urlparse(target)
+        if url.scheme:
+            return KeaHTTPClient(target, **self.client_kwargs)
+        elif url.path.endswith(".csv"):
+            return KeaMemfileClient(target, **self.client_kwargs)
+        elif url.path:
+            return KeaSocketClient(target, **self.client_kwargs)
+
+        click.echo(f"Unable to parse target argument: {target}")
+        return None
+
+    def set_targets(self, targets):
+        current = {target.name: target for target in self.targets}
+
+        clients = []
+        for target in dict.fromkeys(targets):
+            client = current.pop(target, None) or self.create_client(target)
+            if client is None:
                 continue
+            clients.append(client)
+            self.target_locks.setdefault(client, threading.Lock())
+            self.target_health.setdefault(client, TargetHealth(self.failure_threshold, self.max_backoff))
+
+        self.targets = clients
+        self.generation += 1
+
+        for client in current.values():
+            self.remove_target(client)
+
+    def remove_target(self, target):
+        # wait for a running probe of the target to finish
+        with self.target_locks.pop(target):
+            self.snapshots.pop(target, None)
+            self.target_health.pop(target, None)
+
+            plans = [self.key_plans.pop(cache_key) for cache_key in list(self.key_plans) if cache_key[0] is target]
+            if not self.collector:
+                # drop the label children of the target, unless another target exports the same series
+                children = {id(child) for cached in plans for child in self.plan_children(cached)}
+                children -= {id(child) for cached in self.key_plans.values() for child in self.plan_children(cached)}
+                for metric in [*self.metrics_dhcp4.values(), *self.metrics_dhcp6.values()]:
+                    for labelvalues, child in list(metric._metrics.items()):
+                        if id(child) in children:
+                            metric.remove(*labelvalues)
+
+            remove_target_metrics(target.name)
+
+    @staticmethod
+    def plan_children(cached):
+        _, plans, _, aggregates = cached
+        for child in plans.values():
+            if child:
+                yield child
+        for aggregate in aggregates:
+            for child in aggregate[2:]:
+                if child:
+                    yield child
+
+    def read_targets_file(self):
+        if self.targets_file is None:
+            return []
+
+        try:
+            return self.targets_file.read()
+        except (OSError, TypeError, ValueError) as ex:
+            click.echo(f"Failed to read targets file {self.targets_file.path}: {ex!r}", file=sys.stderr)
+            return None
+
+    def reload_targets(self):
+        if self.targets_file is None or not self.targets_file.changed():
+            return
+
+        targets = self.read_targets_file()
+        if targets is None:
+            return
+
+        with self.update_lock:
+            self.set_targets(self.static_targets + targets)
+
+    def get_snapshot_age(self):
+        if self.last_update is None:
+            return float("nan")
+        return time.monotonic() - self.last_update
+
+    def fetch(self, target):
+        # updates and probes may query the same target at the same time
+        with self.target_locks[target]:
+            return list(target.stats())
+
+    def process(self, target, responses, samples=None):
+        changed_series = 0
+        with PHASE_DURATION.labels(target.name, "parse").time():
+            for response in responses:
+                processed, skipped, unhandled, changed = self.parse_metrics(*response, samples=samples, target=target)
+                STATISTICS.labels(target.name, "processed").inc(processed)
+                STATISTICS.labels(target.name, "skipped").inc(skipped)
+                STATISTICS.labels(target.name, "unhandled").inc(unhandled)
+                changed_series += changed
+
+        CHANGED_SERIES.labels(target.name).set(changed_series)
+
+        self.target_health[target].succeeded()
+        TARGET_UP.labels(target.name).set(1)
+        TARGET_FAILURES.labels(target.name).set(0)
+        TARGET_LAST_SUCCESS.labels(target.name).set_to_current_time()
+
+    def fail(self, target):
+        health = self.target_health[target]
+        health.failed()
+        TARGET_UP.labels(target.name).set(0)
+        TARGET_FAILURES.labels(target.name).set(health.failures)
+        self.snapshots.pop(target, None)
+
+    def probe(self, name):
+        target = next((target for target in self.targets if target.name == name), None)
+        if target is None:
+            raise KeyError(name)
 
-            self.targets.append(client)
+        start_time = time.perf_counter()
+        samples = {}
+        with self.target_locks[target]:
+            # the target may have been removed while waiting for its lock
+            if target not in self.target_locks:
+                raise KeyError(name)
+
+            success = False
+            if self.target_health[target].available():
+                # any error of the client is reported as a failed probe
+                try:
+                    self.process(target, list(target.stats()), samples)
+                    success = True
+                except Exception as ex:  # noqa: BLE001
+                    click.echo(f"Failed to query target {target.name}: {ex!r}", file=sys.stderr)
+                    self.fail(target)
+                    samples = {}
+
+        families = list(self.build_families([samples], self.kea_timestamps))
+        families.append(
+            GaugeMetricFamily(
+                f"{self.prefix}_exporter_probe_success", "Whether querying the target succeeded", value=success
+            )
+        )
+        families.append(
+            GaugeMetricFamily(
+                f"{self.prefix}_exporter_probe_duration_seconds",
+                "Time spent querying the target",
+                value=time.perf_counter() - start_time,
+            )
+        )
+        return families
 
     def update(self):
-        for target in self.targets:
-            for response in target.stats():
-                self.parse_metrics(*response)
+        with self.update_lock:
+            self._update()
+
+    def _update(self):
+        # targets whose circuit is open are not queried until their cooldown passed
+        targets = [target for target in self.targets if self.target_health[target].available()]
+        futures = {self.executor.submit(self.fetch, target): target for target in targets}
+
+        succeeded = False
+        try:
+            for future in as_completed(futures, timeout=self.scrape_timeout):
+                target = futures[future]
+                # any error of a client only fails its own target, not the whole update
+                try:
+                    responses = future.result()
+                except Exception as ex:  # noqa: BLE001
+                    click.echo(f"Failed to query target {target.name}: {ex!r}", file=sys.stderr)
+                    self.fail(target)
+                    continue
+
+                samples = {} if self.collector else None
+                self.process(target, responses, samples)
+                succeeded = True
+
+                if self.collector:
+                    self.snapshots[target] = samples
+        except TimeoutError:
+            for future, target in futures.items():
+                if not future.done():
+                    future.cancel()
+                    click.echo(f"Scrape timeout exceeded while querying target {target.name}", file=sys.stderr)
+                    self.fail(target)
+
+        # the snapshot only gets fresher when a target was actually queried
+        if succeeded:
+            self.last_update = time.monotonic()
+        self.generation += 1
 
     def setup_dhcp4_metrics(self):
         self.metrics_dhcp4 = {
             # Packets
-            "sent_packets": Gauge(f"{self.prefix_dhcp4}_packets_sent_total", "Packets sent", ["operation"]),
+            "sent_packets": Gauge(
+                f"{self.prefix_dhcp4}_packets_sent_total", "Packets sent", ["operation"], registry=self.registry
+            ),
             "received_packets": Gauge(
                 f"{self.prefix_dhcp4}_packets_received_total",
                 "Packets received",
                 ["operation"],
+                registry=self.registry,
             ),
             # per Subnet or Subnet pool
             "addresses_allocation_fail": Gauge(
@@ -83,44 +347,93 @@ class Exporter:
                     "subnet_id",
                     "context",
                 ],
+                registry=self.registry,
             ),
             "addresses_assigned_total": Gauge(
                 f"{self.prefix_dhcp4}_addresses_assigned_total",
                 "Assigned addresses",
                 ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
             "addresses_declined_total": Gauge(
                 f"{self.prefix_dhcp4}_addresses_declined_total",
                 "Declined counts",
                 ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
             "addresses_declined_reclaimed_total": Gauge(
                 f"{self.prefix_dhcp4}_addresses_declined_reclaimed_total",
                 "Declined addresses that were reclaimed",
                 ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
+            ),
+            "addresses_expired_total": Gauge(
+                f"{self.prefix_dhcp4}_addresses_expired_total",
+                "Expired addresses that were not reclaimed yet, only computed from lease files",
+                ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
             "addresses_reclaimed_total": Gauge(
                 f"{self.prefix_dhcp4}_addresses_reclaimed_total",
                 "Expired addresses that were reclaimed",
                 ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
             "addresses_total": Gauge(
                 f"{self.prefix_dhcp4}_addresses_total",
                 "Size of subnet address pool",
                 ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
             "reservation_conflicts_total": Gauge(
                 f"{self.prefix_dhcp4}_reservation_conflicts_total",
                 "Reservation conflict count",
                 ["subnet", "subnet_id"],
+                registry=self.registry,
             ),
             "leases_reused_total": Gauge(
                 f"{self.prefix_dhcp4}_leases_reused_total",
                 "Number of times an IPv4 lease has been renewed in memory",
                 ["subnet", "subnet_id"],
+                registry=self.registry,
             ),
         }
 
+        if self.aggregates:
+            self.metrics_dhcp4.update(
+                {
+                    "addresses_utilization": Gauge(
+                        f"{self.prefix_dhcp4}_addresses_utilization_ratio",
+                        "Ratio of assigned to total addresses",
+                        ["subnet", "subnet_id", "pool"],
+                        registry=self.registry,
+                    ),
+                    "shared_network_addresses_assigned": Gauge(
+                        f"{self.prefix_dhcp4}_shared_network_addresses_assigned_total",
+                        "Assigned addresses in the subnets of a shared network",
+                        ["shared_network"],
+                        registry=self.registry,
+                    ),
+                    "shared_network_addresses_total": Gauge(
+                        f"{self.prefix_dhcp4}_shared_network_addresses_total",
+                        "Size of the address pools in the subnets of a shared network",
+                        ["shared_network"],
+                        registry=self.registry,
+                    ),
+                    "shared_network_addresses_utilization": Gauge(
+                        f"{self.prefix_dhcp4}_shared_network_addresses_utilization_ratio",
+                        "Ratio of assigned to total addresses in the subnets of a shared network",
+                        ["shared_network"],
+                        registry=self.registry,
+                    ),
+                }
+            )
+
+        # assigned and total statistics, whether they exist per pool, and the metric prefix of their aggregates
+        self.aggregates_dhcp4 = [
+            ("assigned-addresses", "total-addresses", True, "addresses"),
+        ]
+
         self.metrics_dhcp4_map = {
             # sent_packets
             "pkt4-ack-sent": {
@@ -206,6 +519,9 @@ class Exporter:
             "declined-addresses": {
                 "metric": "addresses_declined_total",
             },
+            "expired-addresses": {
+                "metric": "addresses_expired_total",
+            },
             "reclaimed-declined-addresses": {
                 "metric": "addresses_declined_reclaimed_total",
             },
@@ -246,22 +562,27 @@ class Exporter:
     def setup_dhcp6_metrics(self):
         self.metrics_dhcp6 = {
             # Packets sent/received
-            "sent_packets": Gauge(f"{self.prefix_dhcp6}_packets_sent_total", "Packets sent", ["operation"]),
+            "sent_packets": Gauge(
+                f"{self.prefix_dhcp6}_packets_sent_total", "Packets sent", ["operation"], registry=self.registry
+            ),
             "received_packets": Gauge(
                 f"{self.prefix_dhcp6}_packets_received_total",
                 "Packets received",
                 ["operation"],
+                registry=self.registry,
             ),
             # DHCPv4-over-DHCPv6
             "sent_dhcp4_packets": Gauge(
                 f"{self.prefix_dhcp6}_packets_sent_dhcp4_total",
                 "DHCPv4-over-DHCPv6 Packets received",
                 ["operation"],
+                registry=self.registry,
             ),
             "received_dhcp4_packets": Gauge(
                 f"{self.prefix_dhcp6}_packets_received_dhcp4_total",
                 "DHCPv4-over-DHCPv6 Packets received",
                 ["operation"],
+                registry=self.registry,
             ),
             # per Subnet or pool
             "addresses_allocation_fail": Gauge(
@@ -272,57 +593,138 @@ class Exporter:
                     "subnet_id",
                     "context",
                 ],
+                registry=self.registry,
             ),
             "addresses_declined_total": Gauge(
                 f"{self.prefix_dhcp6}_addresses_declined_total",
                 "Declined addresses",
                 ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
             "addresses_declined_reclaimed_total": Gauge(
                 f"{self.prefix_dhcp6}_addresses_declined_reclaimed_total",
                 "Declined addresses that were reclaimed",
                 ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
+            ),
+            "addresses_expired_total": Gauge(
+                f"{self.prefix_dhcp6}_addresses_expired_total",
+                "Expired addresses that were not reclaimed yet, only computed from lease files",
+                ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
             "addresses_reclaimed_total": Gauge(
                 f"{self.prefix_dhcp6}_addresses_reclaimed_total",
                 "Expired addresses that were reclaimed",
                 ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
             "reservation_conflicts_total": Gauge(
                 f"{self.prefix_dhcp6}_reservation_conflicts_total",
                 "Reservation conflict count",
                 ["subnet", "subnet_id"],
+                registry=self.registry,
             ),
             # IA_NA
             "na_assigned_total": Gauge(
                 f"{self.prefix_dhcp6}_na_assigned_total",
                 "Assigned non-temporary addresses (IA_NA)",
                 ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
             "na_total": Gauge(
                 f"{self.prefix_dhcp6}_na_total",
                 "Size of non-temporary address pool",
                 ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
             "na_reuses_total": Gauge(
-                f"{self.prefix_dhcp6}_na_reuses_total", "Number of IA_NA lease reuses", ["subnet", "subnet_id", "pool"]
+                f"{self.prefix_dhcp6}_na_reuses_total",
+                "Number of IA_NA lease reuses",
+                ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
             # IA_PD
             "pd_assigned_total": Gauge(
                 f"{self.prefix_dhcp6}_pd_assigned_total",
                 "Assigned prefix delegations (IA_PD)",
                 ["subnet", "subnet_id"],
+                registry=self.registry,
             ),
             "pd_total": Gauge(
                 f"{self.prefix_dhcp6}_pd_total",
                 "Size of prefix delegation pool",
                 ["subnet", "subnet_id"],
+                registry=self.registry,
             ),
             "pd_reuses_total": Gauge(
-                f"{self.prefix_dhcp6}_pd_reuses_total", "Number of IA_PD lease reuses", ["subnet", "subnet_id", "pool"]
+                f"{self.prefix_dhcp6}_pd_reuses_total",
+                "Number of IA_PD lease reuses",
+                ["subnet", "subnet_id", "pool"],
+                registry=self.registry,
             ),
         }
 
+        if self.aggregates:
+            self.metrics_dhcp6.update(
+                {
+                    "na_utilization": Gauge(
+                        f"{self.prefix_dhcp6}_na_utilization_ratio",
+                        "Ratio of assigned to total non-temporary addresses (IA_NA)",
+                        ["subnet", "subnet_id", "pool"],
+                        registry=self.registry,
+                    ),
+                    "pd_utilization": Gauge(
+                        f"{self.prefix_dhcp6}_pd_utilization_ratio",
+                        "Ratio of assigned to total prefix delegations (IA_PD)",
+                        ["subnet", "subnet_id"],
+                        registry=self.registry,
+                    ),
+                    "shared_network_na_assigned": Gauge(
+                        f"{self.prefix_dhcp6}_shared_network_na_assigned_total",
+                        "Assigned non-temporary addresses (IA_NA) in the subnets of a shared network",
+                        ["shared_network"],
+                        registry=self.registry,
+                    ),
+                    "shared_network_na_total": Gauge(
+                        f"{self.prefix_dhcp6}_shared_network_na_total",
+                        "Size of the non-temporary address pools in the subnets of a shared network",
+                        ["shared_network"],
+                        registry=self.registry,
+                    ),
+                    "shared_network_na_utilization": Gauge(
+                        f"{self.prefix_dhcp6}_shared_network_na_utilization_ratio",
+                        "Ratio of assigned to total non-temporary addresses (IA_NA) in the subnets of a shared network",
+                        ["shared_network"],
+                        registry=self.registry,
+                    ),
+                    "shared_network_pd_assigned": Gauge(
+                        f"{self.prefix_dhcp6}_shared_network_pd_assigned_total",
+                        "Assigned prefix delegations (IA_PD) in the subnets of a shared network",
+                        ["shared_network"],
+                        registry=self.registry,
+                    ),
+                    "shared_network_pd_total": Gauge(
+                        f"{self.prefix_dhcp6}_shared_network_pd_total",
+                        "Size of the prefix delegation pools in the subnets of a shared network",
+                        ["shared_network"],
+                        registry=self.registry,
+                    ),
+                    "shared_network_pd_utilization": Gauge(
+                        f"{self.prefix_dhcp6}_shared_network_pd_utilization_ratio",
+                        "Ratio of assigned to total prefix delegations (IA_PD) in the subnets of a shared network",
+                        ["shared_network"],
+                        registry=self.registry,
+                    ),
+                }
+            )
+
+        # assigned and total statistics, whether they exist per pool, and the metric prefix of their aggregates
+        self.aggregates_dhcp6 = [
+            ("assigned-nas", "total-nas", True, "na"),
+            ("assigned-pds", "total-pds", False, "pd"),
+        ]
+
         self.metrics_dhcp6_map = {
             # sent_packets
             "pkt6-advertise-sent": {
@@ -421,6 +823,9 @@ class Exporter:
             "declined-addresses": {
                 "metric": "addresses_declined_total",
             },
+            "expired-addresses": {
+                "metric": "addresses_expired_total",
+            },
             "declined-reclaimed-addresses": {
                 "metric": "addresses_declined_reclaimed_total",
             },
@@ -472,104 +877,349 @@ class Exporter:
             "v6-allocation-fail",
         ]
 
-    def parse_metrics(self, dhcp_version, arguments, subnets):
-        for key, data in arguments.items():
-            if dhcp_version is DHCPVersion.DHCP4:
-                if key in self.metrics_dhcp4_global_ignore:
+    def collect(self):
+        return self.build_families(list(self.snapshots.values()), self.kea_timestamps)
+
+    @staticmethod
+    def build_families(snapshots, timestamps=False):
+        # merge the samples of all snapshots, later snapshots win on conflicts
+        metrics = {}
+        for samples in snapshots:
+            for (metric, labelvalues), value in samples.items():
+                metrics.setdefault(metric, {})[labelvalues] = value
+
+        for metric, series in metrics.items():
+            family = GaugeMetricFamily(metric._name, metric._documentation, labels=metric._labelnames)
+            if timestamps:
+                for labelvalues, (value, timestamp) in series.items():
+                    family.add_metric(labelvalues, value, timestamp)
+            else:
+                for labelvalues, value in series.items():
+                    family.add_metric(labelvalues, value)
+            yield family
+
+    def parse_metrics(self, dhcp_version, arguments, subnets, samples=None, target=None):
+        plans, values, aggregates = self.get_key_plans(target, dhcp_version, subnets, samples is not None, arguments)
+        skipped = 0
+        unhandled = 0
+        changed = 0
+
+        if samples is not None and self.kea_timestamps:
+            # The timestamps of a series must never go backwards, so samples that
+            # did not change or are seen for the first time carry the time of
+            # this update. Kea's time is only used when it is later than the
+            # previous sample, and capped at now in case Kea's clock is ahead.
+            now = time.time()
+            for key, data in arguments.items():
+                try:
+                    series = plans[key]
+                except KeyError:
+                    series = plans[key] = self.resolve_key(dhcp_version, key, subnets)
+
+                if not series:
+                    if series is None:
+                        skipped += 1
+                    else:
+                        unhandled += 1
                     continue
-            elif dhcp_version is DHCPVersion.DHCP6:
-                if key in self.metrics_dhcp6_global_ignore:
+
+                value, timestamp = data[0]
+                previous = values.get(key)
+                if previous is not None and previous[0] == timestamp:
+                    # Kea recorded no new sample, it is still valid at the time of this update
+                    values[key] = (timestamp, previous[1], now)
+                    samples[series] = (previous[1], now)
                     continue
-            else:
+
+                # Kea's timestamp may be long past on the first sighting, which
+                # Prometheus would reject as out of bounds
+                exported = now
+                if previous is not None:
+                    kea_time = self.parse_timestamp(timestamp)
+                    if kea_time is not None and kea_time > previous[2]:
+                        exported = min(kea_time, now)
+                values[key] = (timestamp, value, exported)
+                samples[series] = (value, exported)
+                changed += 1
+        elif samples is not None:
+            for key, data in arguments.items():
+                try:
+                    series = plans[key]
+                except KeyError:
+                    series = plans[key] = self.resolve_key(dhcp_version, key, subnets)
+
+                if not series:
+                    if series is None:
+                        skipped += 1
+                    else:
+                        unhandled += 1
+                    continue
+
+                value = samples[series] = data[0][0]
+                if values.get(key) != value:
+                    values[key] = value
+                    changed += 1
+        else:
+            for key, data in arguments.items():
+                # only keys that were set before have a value, so unchanged
+                # values need neither their plan nor their label child
+                value = data[0][0]
+                if values.get(key) == value:
+                    continue
+
+                try:
+                    child = plans[key]
+                except KeyError:
+                    child = plans[key] = self.bind(self.resolve_key(dhcp_version, key, subnets))
+
+                if not child:
+                    if child is None:
+                        skipped += 1
+                    else:
+                        unhandled += 1
+                    continue
+
+                child.set(value)
+                values[key] = value
+                changed += 1
+
+        if aggregates:
+            self.apply_aggregates(arguments, aggregates, samples)
+
+        return len(arguments) - skipped - unhandled, skipped, unhandled, changed
+
+    def apply_aggregates(self, arguments, aggregates, samples=None):
+        for assigned_keys, total_keys, *series in aggregates:
+            assigned = 0
+            total = 0
+            found = False
+            for key in total_keys:
+                data = arguments.get(key)
+                if data:
+                    total += data[0][0]
+                    found = True
+            if not found:
                 continue
+            for key in assigned_keys:
+                data = arguments.get(key)
+                if data:
+                    assigned += data[0][0]
 
-            value, _ = data[0]
-            labels = {}
-
-            subnet_match = self.subnet_pattern.match(key)
-            if subnet_match:
-                subnet_id = int(subnet_match.group("subnet_id"))
-                pool_index = subnet_match.group("pool_index")
-                pool_metric = subnet_match.group("pool_metric")
-                subnet_metric = subnet_match.group("subnet_metric")
-
-                if dhcp_version is DHCPVersion.DHCP4:
-                    if (
-                        pool_metric in self.metric_dhcp4_subnet_ignore
-                        or subnet_metric in self.metric_dhcp4_subnet_ignore
-                    ):
-                        continue
-                elif dhcp_version is DHCPVersion.DHCP6:
-                    if (
-                        pool_metric in self.metric_dhcp6_subnet_ignore
-                        or subnet_metric in self.metric_dhcp6_subnet_ignore
-                    ):
-                        continue
+            values = (assigned / total if total else float("nan"), assigned, total)
+            for child, value in zip(series, values):
+                if not child:
+                    continue
+                if samples is None:
+                    child.set(value)
+                elif self.kea_timestamps:
+                    samples[child] = (value, None)
                 else:
+                    samples[child] = value
+
+    @staticmethod
+    def parse_timestamp(timestamp):
+        # Kea records samples in its local time
+        try:
+            return datetime.fromisoformat(timestamp).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def get_key_plans(self, target, dhcp_version, subnets, series, arguments=None):
+        # Stat keys are resolved once per subnet map, a reloaded configuration
+        # yields a new subnet map and therefore replaces the plans of its target,
+        # together with the last values that were set through them.
+        cache_key = (target, dhcp_version, series)
+        cached = self.key_plans.get(cache_key)
+        if cached is None or cached[0] is not subnets:
+            aggregates = self.get_aggregate_plans(dhcp_version, subnets, series, arguments) if self.aggregates else []
+            cached = self.key_plans[cache_key] = (subnets, {}, {}, aggregates)
+
+        return cached[1], cached[2], cached[3]
+
+    def get_aggregate_plans(self, dhcp_version, subnets, series, arguments):
+        # Lists the assigned and total stat keys of every pool, subnet and shared
+        # network, with the series of their utilization ratio and, for shared
+        # networks, their sums. Kea creates the statistics of all subnets and pools
+        # with the configuration, so those without statistics are left out.
+        if dhcp_version is DHCPVersion.DHCP4:
+            table = self.aggregates_dhcp4
+            metrics = self.metrics_dhcp4
+        elif dhcp_version is DHCPVersion.DHCP6:
+            table = self.aggregates_dhcp6
+            metrics = self.metrics_dhcp6
+        else:
+            return []
+
+        def resolve(metric_key, labels):
+            metric = metrics[metric_key]
+            if not self.series_filter.metric(metric._name):
+                return None
+            labelvalues = tuple(str(labels[name]) for name in metric._labelnames)
+            return (metric, labelvalues) if series else metric.labels(*labelvalues)
+
+        planned = []
+        for assigned_key, total_key, per_pool, kind in table:
+            shared_networks = {}
+            for subnet_id, subnet in subnets.items():
+                if not self.series_filter.subnet(subnet_id):
                     continue
+                assigned = f"subnet[{subnet_id}].{assigned_key}"
+                total = f"subnet[{subnet_id}].{total_key}"
+                if total in arguments:
+                    labels = {"subnet": subnet.prefix, "subnet_id": subnet_id, "pool": ""}
+                    planned.append(((assigned,), (total,), [(f"{kind}_utilization", labels)]))
 
-                subnet_data = subnets.get(subnet_id, [])
-                if not subnet_data:
-                    if subnet_id not in self.subnet_missing_info_sent.get(dhcp_version, []):
-                        self.subnet_missing_info_sent.get(dhcp_version, []).append(subnet_id)
-                        click.echo(
-                            "Ignoring metric because subnet vanished from configuration: "
-                            f"{dhcp_version.name=}, {subnet_id=}",
-                            file=sys.stderr,
-                        )
+                    if subnet.shared_network:
+                        keys = shared_networks.setdefault(subnet.shared_network, ([], []))
+                        keys[0].append(assigned)
+                        keys[1].append(total)
+
+                if not per_pool:
                     continue
+                for pool_index, pool in enumerate(subnet.pools):
+                    assigned = f"subnet[{subnet_id}].pool[{pool_index}].{assigned_key}"
+                    total = f"subnet[{subnet_id}].pool[{pool_index}].{total_key}"
+                    if total in arguments:
+                        labels = {"subnet": subnet.prefix, "subnet_id": subnet_id, "pool": pool}
+                        planned.append(((assigned,), (total,), [(f"{kind}_utilization", labels)]))
 
-                labels["subnet"] = subnet_data.get("subnet")
-                labels["subnet_id"] = subnet_id
-
-                # Check if subnet matches the pool_index
-                if pool_index:
-                    # Matched for subnet pool metrics
-                    pool_index = int(pool_index)
-                    subnet_pools = [pool.get("pool") for pool in subnet_data.get("pools", [])]
-
-                    if len(subnet_pools) <= pool_index:
-                        if f"{subnet_id}-{pool_index}" not in self.subnet_missing_info_sent.get(dhcp_version, []):
-                            self.subnet_missing_info_sent.get(dhcp_version, []).append(f"{subnet_id}-{pool_index}")
-                            click.echo(
-                                "Ignoring metric because subnet vanished from configuration: "
-                                f"{dhcp_version.name=}, {subnet_id=}, {pool_index=}",
-                                file=sys.stderr,
-                            )
-                        continue
-                    key = pool_metric
-                    labels["pool"] = subnet_pools[pool_index]
-                else:
-                    # Matched for subnet metrics
-                    key = subnet_metric
-                    labels["pool"] = ""
+            for shared_network, (assigned, total) in shared_networks.items():
+                labels = {"shared_network": shared_network}
+                metric_keys = ["utilization", "assigned", "total"]
+                planned.append(
+                    (
+                        tuple(assigned),
+                        tuple(total),
+                        [(f"shared_network_{kind}_{metric_key}", labels) for metric_key in metric_keys],
+                    )
+                )
+
+        # series are only resolved for aggregates that are not entirely excluded
+        aggregates = []
+        for assigned, total, targets in planned:
+            resolved = [resolve(metric_key, labels) for metric_key, labels in targets]
+            if any(resolved):
+                aggregates.append((assigned, total, *resolved))
+
+        return aggregates
+
+    def resolve_key(self, dhcp_version, key, subnets):
+        # Returns None for keys that are skipped and False for unhandled keys
+        if dhcp_version is DHCPVersion.DHCP4:
+            if key in self.metrics_dhcp4_global_ignore:
+                return None
+        elif dhcp_version is DHCPVersion.DHCP6:
+            if key in self.metrics_dhcp6_global_ignore:
+                return None
+        else:
+            return None
+
+        # filters only need the key itself, so excluded keys are dropped before any label work
+        level = "global"
+        metric_key = key
+
+        subnet_match = self.subnet_pattern.match(key)
+        if subnet_match:
+            subnet_id = int(subnet_match.group("subnet_id"))
+            pool_index = subnet_match.group("pool_index")
+            pool_metric = subnet_match.group("pool_metric")
+            subnet_metric = subnet_match.group("subnet_metric")
 
             if dhcp_version is DHCPVersion.DHCP4:
-                metrics_map = self.metrics_dhcp4_map
-                metrics = self.metrics_dhcp4
+                if pool_metric in self.metric_dhcp4_subnet_ignore or subnet_metric in self.metric_dhcp4_subnet_ignore:
+                    return None
             elif dhcp_version is DHCPVersion.DHCP6:
-                metrics_map = self.metrics_dhcp6_map
-                metrics = self.metrics_dhcp6
+                if pool_metric in self.metric_dhcp6_subnet_ignore or subnet_metric in self.metric_dhcp6_subnet_ignore:
+                    return None
             else:
-                continue
+                return None
+
+            if not self.series_filter.subnet(subnet_id):
+                return None
+
+            if pool_index:
+                level = "pool"
+                metric_key = pool_metric
+            else:
+                level = "subnet"
+                metric_key = subnet_metric
+
+        if not self.series_filter.level(level):
+            return None
 
-            try:
-                metric_info = metrics_map[key]
-            except KeyError:
-                if key not in self.unhandled_metrics:
+        if dhcp_version is DHCPVersion.DHCP4:
+            metrics_map = self.metrics_dhcp4_map
+            metrics = self.metrics_dhcp4
+        elif dhcp_version is DHCPVersion.DHCP6:
+            metrics_map = self.metrics_dhcp6_map
+            metrics = self.metrics_dhcp6
+        else:
+            return None
+
+        try:
+            metric_info = metrics_map[metric_key]
+        except KeyError:
+            if metric_key not in self.unhandled_metrics:
+                click.echo(
+                    f"Unhandled metric '{metric_key}' please file an issue at https://github.com/mweinelt/kea-exporter"
+                )
+                self.unhandled_metrics.add(metric_key)
+            return False
+
+        metric = metrics[metric_info["metric"]]
+
+        if not self.series_filter.metric(metric._name):
+            return None
+
+        labels = {}
+
+        if subnet_match:
+            subnet = subnets.get(subnet_id)
+            if subnet is None:
+                if subnet_id not in self.subnet_missing_info_sent.get(dhcp_version, []):
+                    self.subnet_missing_info_sent.get(dhcp_version, []).append(subnet_id)
                     click.echo(
-                        f"Unhandled metric '{key}' please file an issue at https://github.com/mweinelt/kea-exporter"
+                        "Ignoring metric because subnet vanished from configuration: "
+                        f"{dhcp_version.name=}, {subnet_id=}",
+                        file=sys.stderr,
                     )
-                    self.unhandled_metrics.add(key)
-                continue
+                return None
+
+            labels["subnet"] = subnet.prefix
+            labels["subnet_id"] = subnet_id
+
+            # Check if subnet matches the pool_index
+            if pool_index:
+                # Matched for subnet pool metrics
+                pool_index = int(pool_index)
+                subnet_pools = subnet.pools
+
+                if len(subnet_pools) <= pool_index:
+                    if f"{subnet_id}-{pool_index}" not in self.subnet_missing_info_sent.get(dhcp_version, []):
+                        self.subnet_missing_info_sent.get(dhcp_version, []).append(f"{subnet_id}-{pool_index}")
+                        click.echo(
+                            "Ignoring metric because subnet vanished from configuration: "
+                            f"{dhcp_version.name=}, {subnet_id=}, {pool_index=}",
+                            file=sys.stderr,
+                        )
+                    return None
+                labels["pool"] = subnet_pools[pool_index]
+            else:
+                # Matched for subnet metrics
+                labels["pool"] = ""
 
-            metric = metrics[metric_info["metric"]]
+        # merge static and dynamic labels
+        labels.update(metric_info.get("labels", {}))
 
-            # merge static and dynamic labels
-            labels.update(metric_info.get("labels", {}))
+        # Filter labels that are not configured for the metric
+        labelvalues = tuple(str(labels[name]) for name in metric._labelnames)
 
-            # Filter labels that are not configured for the metric
-            labels = {key: val for key, val in labels.items() if key in metric._labelnames}
+        return metric, labelvalues
 
-            # export labels and value
-            metric.labels(**labels).set(value)
+    @staticmethod
+    def bind(series):
+        # bind the label child once, so that updates only need to set its value
+        if not series:
+            return series
+        metric, labelvalues = series
+        return metric.labels(*labelvalues)
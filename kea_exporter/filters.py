@@ -0,0 +1,53 @@
+import fnmatch
+import re
+
+LEVELS = ("global", "subnet", "pool")
+
+
+def compile_patterns(patterns):
+    # a single regular expression matches faster than trying every pattern
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns))
+
+
+def parse_subnet_range(value):
+    # accepts a single subnet ID or an inclusive range like 100-199
+    first, _, last = value.partition("-")
+    try:
+        first = int(first)
+        last = int(last) if last else first
+    except ValueError:
+        raise ValueError(f"Invalid subnet ID range: {value}") from None
+    if first > last:
+        raise ValueError(f"Invalid subnet ID range: {value}")
+    return first, last
+
+
+class SeriesFilter:
+    def __init__(
+        self,
+        include_metrics=(),
+        exclude_metrics=(),
+        include_subnets=(),
+        exclude_subnets=(),
+        exclude_levels=(),
+    ):
+        self.include_metrics = compile_patterns(include_metrics)
+        self.exclude_metrics = compile_patterns(exclude_metrics)
+        self.include_subnets = [parse_subnet_range(value) for value in include_subnets]
+        self.exclude_subnets = [parse_subnet_range(value) for value in exclude_subnets]
+        self.exclude_levels = frozenset(exclude_levels)
+
+    def metric(self, name):
+        if self.include_metrics and not self.include_metrics.match(name):
+            return False
+        return not (self.exclude_metrics and self.exclude_metrics.match(name))
+
+    def subnet(self, subnet_id):
+        if self.include_subnets and not any(first <= subnet_id <= last for first, last in self.include_subnets):
+            return False
+        return not any(first <= subnet_id <= last for first, last in self.exclude_subnets)
+
+    def level(self, level):
+        return level not in self.exclude_levels
@@ -0,0 +1,32 @@
+import time
+
+# Cooldown after the circuit of a target opened, doubled with every failed
+# retry up to the maximum backoff.
+INITIAL_BACKOFF = 5
+
+
+class TargetHealth:
+    # A target is queried on every update until it failed failure_threshold
+    # times in a row. Then its circuit opens and it is skipped until the
+    # cooldown passed, after which a single query decides whether it closes
+    # again or stays open for twice as long.
+    __slots__ = ("failure_threshold", "failures", "max_backoff", "retry_at")
+
+    def __init__(self, failure_threshold=3, max_backoff=300):
+        self.failure_threshold = max(1, failure_threshold)
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.retry_at = None
+
+    def available(self):
+        return self.retry_at is None or time.monotonic() >= self.retry_at
+
+    def succeeded(self):
+        self.failures = 0
+        self.retry_at = None
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            exponent = min(self.failures - self.failure_threshold, 32)
+            self.retry_at = time.monotonic() + min(INITIAL_BACKOFF * 2**exponent, self.max_backoff)
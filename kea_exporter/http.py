@@ -1,13 +1,42 @@
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from kea_exporter import DHCPVersion
+from kea_exporter.decoder import ResponseBuffer, StatisticsDecoder
+from kea_exporter.instrumentation import PHASE_DURATION, RESPONSE_SIZE, SUBNETS
+from kea_exporter.subnets import (
+    RESULT_EMPTY,
+    RESULT_UNSUPPORTED,
+    index_config,
+    merge_subnet_list,
+    subnet_cmds_version,
+    subnet_family,
+    subnet_list_cheaper,
+)
 
 
 class KeaHTTPClient:
-    def __init__(self, target, client_cert, client_key, **kwargs):
+    def __init__(
+        self,
+        target,
+        client_cert,
+        client_key,
+        config_max_age=0,
+        timeout=None,
+        connect_timeout=None,
+        http_compression=True,
+        max_response_size=0,
+        **kwargs,
+    ):
         super().__init__()
 
         self._target = target
+        self.name = target
+        self.timeout = (connect_timeout or timeout, timeout)
+        self.max_response_size = int(max_response_size * 1024 * 1024)
+        self.buffer = ResponseBuffer(self.max_response_size)
         if client_cert and client_key:
             self._cert = (
                 client_cert,
@@ -16,54 +45,174 @@ class KeaHTTPClient:
         else:
             self._cert = None
 
-        self.modules = []
+        # Queries to a target are sequential, so a single persistent
+        # connection is enough and saves a (mutual) TLS handshake per query.
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.cert = self._cert
+        self.session.headers.update(
+            {
+                "Content-Type": "application/json",
+                "Accept-Encoding": "gzip" if http_compression else "identity",
+            }
+        )
+
+        # loaded on the first update, so that a target that is down at
+        # startup is set up once it becomes reachable
+        self.modules = None
         self.subnets = {}
         self.subnets6 = {}
 
-        self.load_modules()
-        self.load_subnets()
+        self.config_max_age = config_max_age
+        self.config_hash = None
+        self.config_hash_supported = True
+        self.config_loaded_at = None
 
-    def load_modules(self):
-        r = requests.post(
+        # modules that loaded the subnet_cmds hook, detected on the first load
+        self.subnet_cmds = None
+
+    def query(self, command, decoder=None, **kwargs):
+        r = self.session.post(
             self._target,
-            cert=self._cert,
-            json={"command": "config-get"},
-            headers={"Content-Type": "application/json"},
+            json={"command": command, **kwargs},
+            timeout=self.timeout,
+            stream=True,
         )
-        config = r.json()
+
+        # Read the response into the buffer, or decode it while it is being
+        # received. Reading it to the end returns the connection to the pool.
+        try:
+            for chunk in r.iter_content(65536):
+                if decoder is None:
+                    self.buffer.write(chunk)
+                else:
+                    decoder.feed(chunk)
+        except BaseException:
+            r.close()
+            self.buffer.clear()
+            raise
+
+        if decoder is None:
+            RESPONSE_SIZE.labels(self.name, command).observe(self.buffer.size)
+            return self.buffer.decode()
+
+        response = decoder.close()
+        RESPONSE_SIZE.labels(self.name, command).observe(decoder.size)
+        return response
+
+    def load_modules(self):
+        modules = []
+        config = self.query("config-get")
         for module in config[0]["arguments"]["Control-agent"]["control-sockets"]:
             if "dhcp" in module:  # Does not support d2 metrics. # Does not handle ctrl sockets that are offline
-                self.modules.append(module)
+                modules.append(module)
 
-    def load_subnets(self):
-        r = requests.post(
-            self._target,
-            cert=self._cert,
-            json={"command": "config-get", "service": self.modules},
-            headers={"Content-Type": "application/json"},
-        )
-        config = r.json()
-        for module in config:
-            for subnet in module.get("arguments", {}).get("Dhcp4", {}).get("subnet4", {}):
-                self.subnets.update({subnet["id"]: subnet})
-            for subnet in module.get("arguments", {}).get("Dhcp6", {}).get("subnet6", {}):
-                self.subnets6.update({subnet["id"]: subnet})
+        return modules
+
+    def detect_subnet_cmds(self):
+        subnet_cmds = {}
+        response = self.query("list-commands", service=self.modules)
+        for module, result in zip(self.modules, response):
+            if result.get("result") != 0:
+                continue
+            dhcp_version = subnet_cmds_version(result.get("arguments", []))
+            if dhcp_version is not None:
+                subnet_cmds[module] = dhcp_version
+
+        return subnet_cmds
+
+    def load_subnets(self, config_hash=None):
+        if self.subnet_cmds is None:
+            self.subnet_cmds = self.detect_subnet_cmds()
+
+        subnets = {}
+        subnets6 = {}
+
+        # subnet_cmds avoids transferring host reservations and options
+        config_modules = [module for module in self.modules if module not in self.subnet_cmds]
+        for module, dhcp_version in self.subnet_cmds.items():
+            previous = self.subnets if dhcp_version is DHCPVersion.DHCP4 else self.subnets6
+            if self.config_loaded_at is None or not subnet_list_cheaper(previous, config_hash):
+                config_modules.append(module)
+                continue
+
+            listed = self.list_subnets(module, dhcp_version)
+            if listed is None:
+                config_modules.append(module)
+            elif dhcp_version is DHCPVersion.DHCP4:
+                subnets.update(listed)
+            else:
+                subnets6.update(listed)
+        if config_modules:
+            config = self.query("config-get", service=config_modules)
+            for module in config:
+                subnets.update(index_config(module.get("arguments", {}), DHCPVersion.DHCP4))
+                subnets6.update(index_config(module.get("arguments", {}), DHCPVersion.DHCP6))
+
+        self.subnets = subnets
+        self.subnets6 = subnets6
+        self.config_loaded_at = time.monotonic()
+        SUBNETS.labels(self.name, DHCPVersion.DHCP4.name.lower()).set(len(subnets))
+        SUBNETS.labels(self.name, DHCPVersion.DHCP6.name.lower()).set(len(subnets6))
+
+    def list_subnets(self, module, dhcp_version):
+        family = subnet_family(dhcp_version)
+        response = self.query(f"{family}-list", service=[module])[0]
+        if response.get("result") not in (0, RESULT_EMPTY):
+            raise ValueError(response.get("text"))
+        listed = response.get("arguments", {}).get("subnets", [])
+
+        def get_subnet(subnet_id):
+            response = self.query(f"{family}-get", service=[module], arguments={"id": subnet_id})[0]
+            if response.get("result") != 0:
+                raise ValueError(response.get("text"))
+            return response["arguments"][family][0]
+
+        return merge_subnet_list(listed, get_subnet)
+
+    def get_config_hash(self):
+        if not self.config_hash_supported:
+            return None
+
+        response = self.query("config-hash-get", service=self.modules)
+        if any(module.get("result") == RESULT_UNSUPPORTED for module in response):
+            # config-hash-get is only available since Kea 2.4.0
+            self.config_hash_supported = False
+            return None
+        if any(module.get("result") != 0 for module in response):
+            # e.g. a service that could not be reached, retried on the next update
+            return None
+
+        return tuple(module.get("arguments", {}).get("hash") for module in response)
+
+    def config_changed(self, config_hash):
+        if self.config_loaded_at is None:
+            return True
+        if config_hash is not None:
+            return config_hash != self.config_hash
+        if self.config_hash_supported:
+            # the hash could not be queried this time
+            return True
+        return time.monotonic() - self.config_loaded_at >= self.config_max_age
 
     def stats(self):
-        # Reload subnets on update in case of configurational update
-        self.load_subnets()
+        # Reload subnets on update in case of configurational update, but
+        # only when the configuration hash changed or exceeded its max age.
+        with PHASE_DURATION.labels(self.name, "config").time():
+            if self.modules is None:
+                self.modules = self.load_modules()
+            config_hash = self.get_config_hash()
+            if self.config_changed(config_hash):
+                self.load_subnets(config_hash)
+                self.config_hash = config_hash
+
         # Note for future testing: pipe curl output to jq for an easier read
-        r = requests.post(
-            self._target,
-            cert=self._cert,
-            json={
-                "command": "statistic-get-all",
-                "arguments": {},
-                "service": self.modules,
-            },
-            headers={"Content-Type": "application/json"},
-        )
-        response = r.json()
+        start_time = time.perf_counter()
+        decoder = StatisticsDecoder(self.max_response_size)
+        response = self.query("statistic-get-all", decoder, arguments={}, service=self.modules)
+        PHASE_DURATION.labels(self.name, "statistics").observe(time.perf_counter() - start_time - decoder.duration)
+        PHASE_DURATION.labels(self.name, "decode").observe(decoder.duration)
 
         for index, module in enumerate(self.modules):
             if module == "dhcp4":
@@ -0,0 +1,81 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+PREFIX = "kea_exporter"
+
+PHASE_DURATION = Histogram(
+    f"{PREFIX}_phase_duration_seconds",
+    "Time spent per target in each phase of an update",
+    ["target", "phase"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+RENDER_DURATION = Histogram(
+    f"{PREFIX}_render_duration_seconds",
+    "Time spent rendering the exposition",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+RESPONSE_SIZE = Histogram(
+    f"{PREFIX}_response_size_bytes",
+    "Size of the responses received from Kea",
+    ["target", "command"],
+    buckets=(1e3, 1e4, 1e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8),
+)
+STATISTICS = Counter(
+    f"{PREFIX}_statistics",
+    "Statistic keys received from Kea, by how they were handled",
+    ["target", "outcome"],
+)
+CHANGED_SERIES = Gauge(
+    f"{PREFIX}_changed_series",
+    "Series of the target whose value changed in its last update",
+    ["target"],
+)
+SUBNETS = Gauge(
+    f"{PREFIX}_subnets",
+    "Subnets indexed from the configuration",
+    ["target", "dhcp_version"],
+)
+TARGET_UP = Gauge(
+    f"{PREFIX}_target_up",
+    "Whether the last update of the target succeeded",
+    ["target"],
+)
+TARGET_LAST_SUCCESS = Gauge(
+    f"{PREFIX}_target_last_success_timestamp_seconds",
+    "Time of the last successful update of the target",
+    ["target"],
+)
+TARGET_FAILURES = Gauge(
+    f"{PREFIX}_target_consecutive_failures",
+    "Updates of the target that failed in a row",
+    ["target"],
+)
+
+PUSH_REQUESTS = Counter(
+    f"{PREFIX}_push_requests",
+    "Push requests, by whether they succeeded, failed and are retried, were rejected or dropped from the buffer",
+    ["outcome"],
+)
+PUSH_BUFFERED = Gauge(
+    f"{PREFIX}_push_buffered_requests",
+    "Push requests waiting to be retried",
+)
+
+
+# metrics that are labelled by target
+TARGET_METRICS = (
+    PHASE_DURATION,
+    RESPONSE_SIZE,
+    STATISTICS,
+    CHANGED_SERIES,
+    SUBNETS,
+    TARGET_UP,
+    TARGET_LAST_SUCCESS,
+    TARGET_FAILURES,
+)
+
+
+def remove_target_metrics(target):
+    for metric in TARGET_METRICS:
+        for labelvalues in list(metric._metrics):
+            if labelvalues[0] == target:
+                metric.remove(*labelvalues)
@@ -0,0 +1,341 @@
+import heapq
+import ipaddress
+import json
+import mmap
+import os
+import re
+import socket
+import time
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime
+
+from kea_exporter import DHCPVersion
+from kea_exporter.instrumentation import PHASE_DURATION, RESPONSE_SIZE, SUBNETS
+from kea_exporter.subnets import config_subnets, index_subnet
+
+# lease states as written by Kea
+STATE_DEFAULT = 0
+STATE_DECLINED = 1
+
+# lease types of DHCPv6 leases
+LEASE_TYPE_NA = 0
+LEASE_TYPE_PD = 2
+
+# columns that are read from lease files, state and lease_type are optional
+LEASE_COLUMNS = ("address", "valid_lifetime", "expire", "subnet_id", "state", "lease_type")
+
+# Kea's configuration allows comments in the styles of C, C++ and shell
+CONFIG_COMMENTS = re.compile(r'("(?:\\.|[^"\\])*")|/\*.*?\*/|//[^\n]*|#[^\n]*', re.DOTALL)
+
+
+def load_config(path):
+    with open(path) as fd:
+        return json.loads(CONFIG_COMMENTS.sub(lambda match: match.group(1) or "", fd.read()))
+
+
+def pool_range(pool):
+    # pools are either written as a range or as a prefix
+    if "-" in pool:
+        first, last = pool.split("-", 1)
+        return int(ipaddress.ip_address(first.strip())), int(ipaddress.ip_address(last.strip()))
+
+    network = ipaddress.ip_network(pool.strip(), strict=False)
+    return int(network.network_address), int(network.broadcast_address)
+
+
+class KeaMemfileClient:
+    # Computes lease statistics from the lease files of Kea's memfile backend
+    # instead of querying Kea. Lease files are an append-only log, in which
+    # the last line of an address wins, so the current file is tailed and
+    # only read again as a whole when the lease file cleanup (LFC) rotated it.
+    def __init__(self, lease_file, kea_configs=(), **kwargs):
+        super().__init__()
+
+        self.lease_file = os.path.abspath(lease_file)
+        self.name = lease_file
+        self.kea_configs = kea_configs
+
+        self.dhcp_version = None
+        self.subnets = None
+        self.config_file = None
+        self.config_mtime = None
+        # address ranges per subnet ID, and the number of addresses and prefixes they hold
+        self.pools = {}
+        self.config_values = {}
+
+        # position in the current lease file, see tail()
+        self.inode = None
+        self.offset = 0
+        self.columns = None
+
+        # lease key -> [stat keys, stat keys once expired, expiry, expired]
+        self.leases = {}
+        self.lease_keys = {}
+        self.counts = Counter()
+        # unexpired leases by their expiry, outdated entries are skipped when they are due
+        self.expiry = []
+        # last value and time of every stat key, so that unchanged samples keep their time
+        self.samples = {}
+
+    @property
+    def address_family(self):
+        return socket.AF_INET if self.dhcp_version is DHCPVersion.DHCP4 else socket.AF_INET6
+
+    def stats(self):
+        with PHASE_DURATION.labels(self.name, "config").time():
+            if self.dhcp_version is None:
+                self.dhcp_version = self.detect_version()
+            if self.config_changed():
+                self.reload()
+
+        with PHASE_DURATION.labels(self.name, "statistics").time():
+            self.tail()
+            arguments = self.get_arguments()
+
+        yield self.dhcp_version, arguments, self.subnets
+
+    def detect_version(self):
+        with open(self.lease_file, "rb") as fd:
+            header = fd.readline().decode().strip().split(",")
+        if header[0] != "address":
+            raise ValueError(f"Lease file {self.lease_file} has no header")
+        return DHCPVersion.DHCP6 if "duid" in header else DHCPVersion.DHCP4
+
+    def find_config(self):
+        # prefer the configuration whose lease database is this file
+        server_name = "Dhcp4" if self.dhcp_version is DHCPVersion.DHCP4 else "Dhcp6"
+        candidates = []
+        for path in self.kea_configs:
+            config = load_config(path)
+            server = config.get(server_name)
+            if server is None:
+                continue
+            lease_database = server.get("lease-database", {}).get("name")
+            if lease_database and os.path.abspath(lease_database) == self.lease_file:
+                return path, config
+            candidates.append((path, config))
+
+        return candidates[0] if candidates else (None, {})
+
+    def config_changed(self):
+        if self.subnets is None:
+            return True
+        if self.config_file is None:
+            return False
+        return os.stat(self.config_file).st_mtime_ns != self.config_mtime
+
+    def reload(self):
+        config_file, config = self.find_config()
+        if config_file is not None:
+            self.config_mtime = os.stat(config_file).st_mtime_ns
+        self.config_file = config_file
+
+        subnets = {}
+        pools = {}
+        config_values = {}
+        if self.dhcp_version is DHCPVersion.DHCP4:
+            total = "total-addresses"
+            names = ("assigned-addresses", "declined-addresses", "expired-addresses")
+        else:
+            total = "total-nas"
+            names = ("assigned-nas", "declined-addresses", "expired-addresses")
+        for subnet, shared_network in config_subnets(config, self.dhcp_version):
+            subnet_id = subnet["id"]
+            subnets[subnet_id] = index_subnet(subnet, shared_network)
+
+            ranges = sorted((*pool_range(pool["pool"]), index) for index, pool in enumerate(subnet.get("pools", [])))
+            if ranges:
+                pools[subnet_id] = ([first for first, _, _ in ranges], ranges)
+
+            prefixes = [f"subnet[{subnet_id}]."]
+            config_values[f"subnet[{subnet_id}].{total}"] = 0
+            for first, last, index in ranges:
+                config_values[f"subnet[{subnet_id}].{total}"] += last - first + 1
+                config_values[f"subnet[{subnet_id}].pool[{index}].{total}"] = last - first + 1
+                prefixes.append(f"subnet[{subnet_id}].pool[{index}].")
+
+            if self.dhcp_version is DHCPVersion.DHCP6:
+                config_values[f"subnet[{subnet_id}].total-pds"] = 0
+                config_values[f"subnet[{subnet_id}].assigned-pds"] = 0
+                for pd_pool in subnet.get("pd-pools", []):
+                    delegated = pd_pool.get("delegated-len", 128) - pd_pool.get("prefix-len", 128)
+                    config_values[f"subnet[{subnet_id}].total-pds"] += 2 ** max(0, delegated)
+
+            # subnets and pools without leases report zero, like Kea does
+            for prefix in prefixes:
+                for name in names:
+                    config_values[prefix + name] = 0
+
+        # leases are counted per pool, so that they are read again with the new pools
+        self.subnets = subnets
+        self.pools = pools
+        self.config_values = config_values
+        self.lease_keys = {}
+        self.inode = None
+        SUBNETS.labels(self.name, self.dhcp_version.name.lower()).set(len(subnets))
+
+    def tail(self):
+        with open(self.lease_file, "rb") as fd:
+            stat = os.fstat(fd.fileno())
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                # The LFC moved the current file to .2 and started a new one, or
+                # merged .1 and .2 into .completed. Together with the current
+                # file these hold every lease.
+                self.leases = {}
+                self.counts = Counter()
+                self.expiry = []
+                self.inode = stat.st_ino
+                self.offset = 0
+                self.columns = None
+
+                for path in self.previous_files():
+                    try:
+                        with open(path, "rb") as previous_fd:
+                            self.read(previous_fd, 0, None)
+                    except FileNotFoundError:
+                        continue
+
+            self.offset, self.columns = self.read(fd, self.offset, self.columns)
+
+    def previous_files(self):
+        # .completed is the result of an LFC run that was not moved to .1 yet
+        completed = f"{self.lease_file}.completed"
+        if os.path.exists(completed):
+            return [completed]
+        return [f"{self.lease_file}.1", f"{self.lease_file}.2"]
+
+    def read(self, fd, offset, columns):
+        # Reads the complete lines from offset on, a partial line at the end
+        # is still being written and read on the next update.
+        size = os.fstat(fd.fileno()).st_size
+        if size <= offset:
+            return offset, columns
+
+        with mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ) as data:
+            end = data.rfind(b"\n", offset) + 1
+            if end <= offset:
+                return offset, columns
+            RESPONSE_SIZE.labels(self.name, "lease-file").observe(end - offset)
+
+            data.seek(offset)
+            now = time.time()
+            while data.tell() < end:
+                line = data.readline().rstrip(b"\r\n").decode("utf-8", "replace")
+                if not line:
+                    continue
+                fields = line.split(",")
+                if fields[0] == "address":
+                    names = {name: index for index, name in enumerate(fields)}
+                    columns = tuple(names.get(name) for name in LEASE_COLUMNS)
+                    continue
+                if columns is not None:
+                    self.apply(fields, columns, now)
+
+        return end, columns
+
+    def apply(self, fields, columns, now):
+        address_index, lifetime_index, expire_index, subnet_index, state_index, type_index = columns
+        try:
+            address = fields[address_index]
+            valid_lifetime = int(fields[lifetime_index])
+            expire = int(fields[expire_index])
+            subnet_id = int(fields[subnet_index])
+            state = STATE_DEFAULT if state_index is None else int(fields[state_index])
+            lease_type = LEASE_TYPE_NA if type_index is None else int(fields[type_index])
+        except (IndexError, TypeError, ValueError):
+            return
+
+        # temporary addresses (IA_TA) have no statistics in Kea
+        if lease_type not in (LEASE_TYPE_NA, LEASE_TYPE_PD):
+            return
+
+        key = (address, lease_type)
+        self.remove(key)
+
+        # a lifetime of zero marks a deleted lease, reclaimed and released
+        # leases are kept in the file, but no longer assigned
+        if valid_lifetime == 0 or state not in (STATE_DEFAULT, STATE_DECLINED):
+            return
+
+        pool = None
+        pools = self.pools.get(subnet_id) if lease_type == LEASE_TYPE_NA else None
+        if pools:
+            firsts, ranges = pools
+            try:
+                value = int.from_bytes(socket.inet_pton(self.address_family, address), "big")
+            except (OSError, ValueError):
+                value = -1
+            position = bisect_right(firsts, value) - 1
+            if position >= 0 and value <= ranges[position][1]:
+                pool = ranges[position][2]
+
+        try:
+            keys, expired_keys = self.lease_keys[(subnet_id, pool, lease_type, state)]
+        except KeyError:
+            keys, expired_keys = self.lease_keys[(subnet_id, pool, lease_type, state)] = self.get_lease_keys(
+                subnet_id, pool, lease_type, state
+            )
+        counts = self.counts
+        for stat_key in keys:
+            counts[stat_key] += 1
+
+        lease = self.leases[key] = [keys, expired_keys, expire, False]
+        if expired_keys:
+            if expire <= now:
+                self.expire(lease)
+            else:
+                heapq.heappush(self.expiry, (expire, key))
+
+    def get_lease_keys(self, subnet_id, pool, lease_type, state):
+        # the stat keys a lease counts towards, and those it adds once it expired
+        prefixes = [f"subnet[{subnet_id}]."]
+        if pool is not None:
+            prefixes.append(f"subnet[{subnet_id}].pool[{pool}].")
+
+        if lease_type == LEASE_TYPE_PD:
+            return (f"subnet[{subnet_id}].assigned-pds",), ()
+
+        names = ["assigned-addresses" if self.dhcp_version is DHCPVersion.DHCP4 else "assigned-nas"]
+        if state == STATE_DECLINED:
+            names.append("declined-addresses")
+
+        keys = tuple(prefix + name for prefix in prefixes for name in names)
+        expired_keys = tuple(prefix + "expired-addresses" for prefix in prefixes) if state == STATE_DEFAULT else ()
+        return keys, expired_keys
+
+    def remove(self, key):
+        lease = self.leases.pop(key, None)
+        if lease is None:
+            return
+
+        self.counts.subtract(lease[0])
+        if lease[3]:
+            self.counts.subtract(lease[1])
+
+    def expire(self, lease):
+        # expired leases remain assigned until Kea reclaims them
+        lease[3] = True
+        self.counts.update(lease[1])
+
+    def get_arguments(self):
+        now = time.time()
+        while self.expiry and self.expiry[0][0] <= now:
+            expire, key = heapq.heappop(self.expiry)
+            lease = self.leases.get(key)
+            if lease is not None and lease[2] == expire and not lease[3]:
+                self.expire(lease)
+
+        # samples carry the time their value changed, like Kea's own
+        timestamp = datetime.now().isoformat(" ")
+        values = dict(self.config_values)
+        values.update(self.counts)
+
+        arguments = {}
+        for key, value in values.items():
+            sample = self.samples.get(key)
+            if sample is None or sample[0] != value:
+                sample = self.samples[key] = [value, timestamp]
+            arguments[key] = [sample]
+
+        return arguments
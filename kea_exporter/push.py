@@ -0,0 +1,194 @@
+import gzip
+import socket
+import struct
+import sys
+import threading
+import time
+from base64 import urlsafe_b64encode
+from collections import deque
+from urllib.parse import quote
+
+import click
+import requests
+from prometheus_client.exposition import generate_latest
+from requests.adapters import HTTPAdapter
+
+from kea_exporter.instrumentation import PUSH_BUFFERED, PUSH_REQUESTS
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+PUSH_FORMATS = ("remote-write", "pushgateway")
+
+
+def encode_varint(value):
+    data = bytearray()
+    while value > 0x7F:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def encode_field(number, payload):
+    # length-delimited protobuf field
+    return encode_varint(number << 3 | 2) + encode_varint(len(payload)) + payload
+
+
+def encode_timeseries(labels, value, timestamp):
+    # prometheus.TimeSeries within a prometheus.WriteRequest, see
+    # https://prometheus.io/docs/concepts/remote_write_spec/
+    body = b"".join(
+        encode_field(1, encode_field(1, label_name.encode()) + encode_field(2, label_value.encode()))
+        for label_name, label_value in labels
+    )
+    sample = b"\x09" + struct.pack("<d", value) + b"\x10" + encode_varint(timestamp & 0xFFFFFFFFFFFFFFFF)
+    return encode_field(1, body + encode_field(2, sample))
+
+
+def snappy_compress(data):
+    if snappy is not None:
+        return snappy.compress(data)
+
+    # Without python-snappy the data is written as literals, which is a valid
+    # snappy block, but not any smaller.
+    block = bytearray(encode_varint(len(data)))
+    for offset in range(0, len(data), 65536):
+        chunk = data[offset : offset + 65536]
+        length = len(chunk) - 1
+        if length < 60:
+            block.append(length << 2)
+        elif length < 256:
+            block += bytes((60 << 2, length))
+        else:
+            block.append(61 << 2)
+            block += length.to_bytes(2, "little")
+        block += chunk
+    return bytes(block)
+
+
+def grouping_path(labels):
+    # Pushgateway grouping key, values that do not fit into a path segment are base64 encoded
+    path = ""
+    for name, value in sorted(labels.items(), key=lambda label: label[0] != "job"):
+        if not value or "/" in value:
+            path += f"/{name}@base64/{urlsafe_b64encode(value.encode()).decode() or '='}"
+        else:
+            path += f"/{name}/{quote(value, safe='')}"
+    return path
+
+
+class Pusher(threading.Thread):
+    # Updates the exporter every interval and pushes the registry, requests
+    # that could not be sent are retried on the next push, up to buffer_size.
+    def __init__(
+        self,
+        exporter,
+        registry,
+        url,
+        interval,
+        push_format="remote-write",
+        labels=None,
+        batch_size=2000,
+        buffer_size=100,
+        timeout=None,
+    ):
+        super().__init__(name="kea-exporter-pusher", daemon=True)
+
+        self.exporter = exporter
+        self.registry = registry
+        self.interval = interval
+        self.push_format = push_format
+        self.labels = {"job": "kea_exporter", "instance": socket.gethostname(), **(labels or {})}
+        self.batch_size = max(1, batch_size)
+        self.timeout = timeout
+
+        # the Pushgateway replaces the group with every push, so only the latest is kept
+        self.buffer = deque(maxlen=1 if push_format == "pushgateway" else max(1, buffer_size))
+
+        if push_format == "pushgateway":
+            self.url = url.rstrip("/") + "/metrics" + grouping_path(self.labels)
+            self.method = "PUT"
+            headers = {"Content-Type": "text/plain; version=0.0.4", "Content-Encoding": "gzip"}
+        else:
+            self.url = url
+            self.method = "POST"
+            headers = {
+                "Content-Type": "application/x-protobuf",
+                "Content-Encoding": "snappy",
+                "X-Prometheus-Remote-Write-Version": "0.1.0",
+            }
+
+        # pushes are sequential, so a single persistent connection is enough
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.headers.update(headers)
+
+    def run(self):
+        while True:
+            start_time = time.monotonic()
+            # the pusher must keep running, whatever went wrong with this push
+            try:
+                self.exporter.update()
+                self.push()
+            except Exception as ex:  # noqa: BLE001
+                click.echo(f"Failed to push metrics: {ex!r}", file=sys.stderr)
+            time.sleep(max(0, self.interval - (time.monotonic() - start_time)))
+
+    def push(self):
+        for payload in self.encode():
+            if len(self.buffer) == self.buffer.maxlen and self.push_format != "pushgateway":
+                PUSH_REQUESTS.labels("dropped").inc()
+            self.buffer.append(payload)
+
+        while self.buffer:
+            if not self.send(self.buffer[0]):
+                break
+            self.buffer.popleft()
+
+        PUSH_BUFFERED.set(len(self.buffer))
+
+    def encode(self):
+        if self.push_format == "pushgateway":
+            yield gzip.compress(generate_latest(self.registry), compresslevel=6)
+            return
+
+        timestamp = int(time.time() * 1000)
+        batch = []
+        for metric in self.registry.collect():
+            for sample in metric.samples:
+                labels = sorted({**self.labels, **sample.labels, "__name__": sample.name}.items())
+                sample_timestamp = timestamp if sample.timestamp is None else int(float(sample.timestamp) * 1000)
+                batch.append(encode_timeseries(labels, sample.value, sample_timestamp))
+                if len(batch) == self.batch_size:
+                    yield snappy_compress(b"".join(batch))
+                    batch = []
+        if batch:
+            yield snappy_compress(b"".join(batch))
+
+    def send(self, payload):
+        # Returns whether the payload is done with, requests that the receiver
+        # rejected are dropped, as retrying them would not help.
+        try:
+            response = self.session.request(self.method, self.url, data=payload, timeout=self.timeout)
+        except requests.RequestException as ex:
+            click.echo(f"Failed to push metrics to {self.url}: {ex!r}", file=sys.stderr)
+            PUSH_REQUESTS.labels("failure").inc()
+            return False
+
+        if response.status_code < 300:
+            PUSH_REQUESTS.labels("success").inc()
+            return True
+
+        click.echo(
+            f"Failed to push metrics to {self.url}: {response.status_code} {response.text[:200]}", file=sys.stderr
+        )
+        if response.status_code == 429 or response.status_code >= 500:
+            PUSH_REQUESTS.labels("failure").inc()
+            return False
+
+        PUSH_REQUESTS.labels("rejected").inc()
+        return True
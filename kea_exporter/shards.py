@@ -0,0 +1,255 @@
+import hashlib
+import multiprocessing
+import sys
+import threading
+import time
+from bisect import bisect
+
+import click
+from prometheus_client import GC_COLLECTOR, PLATFORM_COLLECTOR, PROCESS_COLLECTOR, REGISTRY, Gauge
+from prometheus_client.metrics_core import Metric
+
+from kea_exporter.exporter import Exporter
+from kea_exporter.instrumentation import PUSH_BUFFERED, PUSH_REQUESTS, RENDER_DURATION, TARGET_METRICS
+from kea_exporter.targets import TargetsFile
+
+
+def hash_key(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    # Consistent hashing keeps a target on the same worker while other
+    # targets come and go, together with its cached subnets and key plans.
+    def __init__(self, nodes, replicas=64):
+        self.ring = sorted(
+            (hash_key(f"{node}:{replica}"), node) for node in range(nodes) for replica in range(replicas)
+        )
+        self.keys = [key for key, _ in self.ring]
+
+    def get(self, key):
+        return self.ring[bisect(self.keys, hash_key(key)) % len(self.ring)][1]
+
+
+def run_worker(connection, targets, kwargs):
+    # The parent process exports its own process metrics and timings, the
+    # worker only reports the metrics of its targets.
+    for collector in (PROCESS_COLLECTOR, PLATFORM_COLLECTOR, GC_COLLECTOR):
+        REGISTRY.unregister(collector)
+    for metric in (RENDER_DURATION, PUSH_REQUESTS, PUSH_BUFFERED):
+        REGISTRY.unregister(metric)
+
+    exporter = Exporter(targets, **kwargs)
+    REGISTRY.unregister(exporter.snapshot_age)
+
+    while True:
+        try:
+            command, argument = connection.recv()
+        except EOFError:
+            return
+
+        try:
+            if command == "update":
+                last_update = exporter.last_update
+                exporter.update()
+                connection.send(("ok", (list(REGISTRY.collect()), exporter.last_update != last_update)))
+            elif command == "targets":
+                with exporter.update_lock:
+                    exporter.set_targets(argument)
+                connection.send(("ok", None))
+            elif command == "probe":
+                connection.send(("ok", exporter.probe(argument)))
+        except KeyError:
+            connection.send(("missing", None))
+        # any other error is passed to the parent, the worker keeps serving
+        except Exception as ex:  # noqa: BLE001
+            connection.send(("error", repr(ex)))
+
+
+class Worker:
+    def __init__(self, index, kwargs):
+        self.index = index
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.targets = []
+        self.families = []
+        self.process = None
+        self.connection = None
+
+    def start(self):
+        # spawned workers do not inherit the threads and sockets of the parent
+        context = multiprocessing.get_context("spawn")
+        self.connection, child = context.Pipe()
+        self.process = context.Process(
+            target=run_worker,
+            args=(child, self.targets, self.kwargs),
+            name=f"kea-exporter-worker-{self.index}",
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+
+    def send(self, command, argument=None):
+        self.connection.send((command, argument))
+
+    def receive(self):
+        status, result = self.connection.recv()
+        if status == "missing":
+            raise KeyError(result)
+        if status == "error":
+            raise RuntimeError(result)
+        return result
+
+    def request(self, command, argument=None):
+        with self.lock:
+            try:
+                self.send(command, argument)
+                return self.receive()
+            except (EOFError, OSError):
+                self.restart()
+                raise
+
+    def restart(self):
+        click.echo(f"Worker {self.index} exited, restarting it", file=sys.stderr)
+        self.process.kill()
+        self.process.join()
+        self.families = []
+        self.start()
+
+
+class ShardedExporter:
+    # Splits the targets across worker processes, that each query and parse
+    # their shard in their own interpreter, and merges the metric families
+    # of all workers after every update.
+    def __init__(self, targets, processes, targets_file=None, **kwargs):
+        self.ring = HashRing(processes)
+        self.workers = [Worker(index, kwargs) for index in range(processes)]
+
+        self.update_lock = threading.Lock()
+        self.last_update = None
+        self.generation = 0
+        self.families = []
+        self.snapshot_age = Gauge(
+            "kea_exporter_snapshot_age_seconds",
+            "Seconds since the exported statistics were last queried from Kea",
+        )
+        self.snapshot_age.set_function(self.get_snapshot_age)
+        self.live_collectors = [self.snapshot_age]
+
+        self.static_targets = list(targets)
+        self.targets_file = TargetsFile(targets_file) if targets_file else None
+        self.targets = []
+        self.shard(self.static_targets + (self.read_targets_file() or []))
+        for worker in self.workers:
+            worker.start()
+
+        # the workers export the metrics of their targets
+        for metric in TARGET_METRICS:
+            REGISTRY.unregister(metric)
+        REGISTRY.register(self)
+
+    def shard(self, targets):
+        shards = [[] for _ in self.workers]
+        for target in dict.fromkeys(targets):
+            shards[self.ring.get(target)].append(target)
+
+        changed = []
+        for worker, shard in zip(self.workers, shards):
+            if worker.targets != shard:
+                worker.targets = shard
+                changed.append(worker)
+
+        self.targets = list(dict.fromkeys(targets))
+        return changed
+
+    def read_targets_file(self):
+        if self.targets_file is None:
+            return []
+
+        try:
+            return self.targets_file.read()
+        except (OSError, TypeError, ValueError) as ex:
+            click.echo(f"Failed to read targets file {self.targets_file.path}: {ex!r}", file=sys.stderr)
+            return None
+
+    def reload_targets(self):
+        if self.targets_file is None or not self.targets_file.changed():
+            return
+
+        targets = self.read_targets_file()
+        if targets is None:
+            return
+
+        with self.update_lock:
+            for worker in self.shard(self.static_targets + targets):
+                try:
+                    worker.request("targets", worker.targets)
+                # a worker that exited is restarted with its new targets by request()
+                except (EOFError, OSError, KeyError, RuntimeError) as ex:
+                    click.echo(f"Failed to update targets of worker {worker.index}: {ex!r}", file=sys.stderr)
+            self.generation += 1
+
+    def get_snapshot_age(self):
+        if self.last_update is None:
+            return float("nan")
+        return time.monotonic() - self.last_update
+
+    def probe(self, name):
+        if name not in self.targets:
+            raise KeyError(name)
+        return self.workers[self.ring.get(name)].request("probe", name)
+
+    def update(self):
+        with self.update_lock:
+            self._update()
+
+    def _update(self):
+        # all workers update at the same time, each one holds its lock until it answered
+        pending = []
+        for worker in self.workers:
+            worker.lock.acquire()
+            try:
+                worker.send("update")
+                pending.append(worker)
+            except OSError:
+                worker.restart()
+                worker.lock.release()
+
+        succeeded = False
+        for worker in pending:
+            try:
+                worker.families, updated = worker.receive()
+                succeeded = succeeded or updated
+            except (EOFError, OSError):
+                worker.restart()
+            except RuntimeError as ex:
+                click.echo(f"Failed to update worker {worker.index}: {ex}", file=sys.stderr)
+            finally:
+                worker.lock.release()
+
+        self.families = self.merge([worker.families for worker in self.workers])
+        # the snapshot only gets fresher when a worker queried a target
+        if succeeded:
+            self.last_update = time.monotonic()
+        self.generation += 1
+
+    @staticmethod
+    def merge(shards):
+        # families of the same name are joined, series that several workers
+        # export, like the global statistics of Kea, are taken from the last
+        families = {}
+        samples = {}
+        for shard in shards:
+            for family in shard:
+                if family.name not in families:
+                    families[family.name] = Metric(family.name, family.documentation, family.type, family.unit)
+                    samples[family.name] = {}
+                for sample in family.samples:
+                    samples[family.name][(sample.name, tuple(sorted(sample.labels.items())))] = sample
+
+        for name, family in families.items():
+            family.samples = list(samples[name].values())
+        return list(families.values())
+
+    def collect(self):
+        return self.families
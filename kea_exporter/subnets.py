@@ -0,0 +1,83 @@
+from kea_exporter import DHCPVersion
+
+# Kea answers commands that found nothing, e.g. listing the subnets of an
+# empty configuration, with this result code
+RESULT_EMPTY = 3
+# and commands that it does not know, e.g. config-hash-get before Kea 2.4.0
+RESULT_UNSUPPORTED = 2
+
+# Beyond this many subnets a single config-get is cheaper than fetching them
+# one by one.
+MAX_SUBNET_GETS = 100
+
+
+class Subnet:
+    # Only what labels the statistics of a subnet is kept, so that the
+    # configuration can be released right after indexing.
+    __slots__ = ("pools", "prefix", "shared_network")
+
+    def __init__(self, prefix, pools=(), shared_network=None):
+        self.prefix = prefix
+        self.pools = pools
+        self.shared_network = shared_network
+
+
+def index_subnet(subnet, shared_network=None):
+    return Subnet(
+        subnet.get("subnet"),
+        tuple(pool.get("pool") for pool in subnet.get("pools", [])),
+        shared_network or subnet.get("shared-network-name"),
+    )
+
+
+def config_subnets(config, dhcp_version):
+    # yields the subnets of a configuration with the name of their shared network
+    family = subnet_family(dhcp_version)
+    server = config.get("Dhcp4" if dhcp_version is DHCPVersion.DHCP4 else "Dhcp6", {})
+
+    for subnet in server.get(family, []):
+        yield subnet, None
+    for shared_network in server.get("shared-networks", []):
+        for subnet in shared_network.get(family, []):
+            yield subnet, shared_network.get("name")
+
+
+def index_config(config, dhcp_version):
+    # maps subnet IDs to Subnet records, including subnets in shared networks
+    return {
+        subnet["id"]: index_subnet(subnet, shared_network)
+        for subnet, shared_network in config_subnets(config, dhcp_version)
+    }
+
+
+def subnet_cmds_version(commands):
+    # The subnet_cmds hook registers subnet4-list or subnet6-list on the
+    # server that loaded it.
+    if "subnet4-list" in commands:
+        return DHCPVersion.DHCP4
+    if "subnet6-list" in commands:
+        return DHCPVersion.DHCP6
+    return None
+
+
+def subnet_family(dhcp_version):
+    return "subnet4" if dhcp_version is DHCPVersion.DHCP4 else "subnet6"
+
+
+def subnet_list_cheaper(subnets, config_hash):
+    # Listing the subnets and fetching each of them only pays off on a reload
+    # after a change that config-hash-get reported, and for few subnets. The
+    # first load and reloads by age, which mostly find nothing changed, use a
+    # single config-get instead.
+    return config_hash is not None and subnets is not None and len(subnets) <= MAX_SUBNET_GETS
+
+
+def merge_subnet_list(listed, get_subnet):
+    # The listing only holds the ID and prefix of each subnet, while a changed
+    # configuration may have changed the pools or shared network of any of
+    # them, so every listed subnet is fetched again. Returns a new map, so
+    # that stat keys are resolved again, or None if config-get is cheaper.
+    if len(listed) > MAX_SUBNET_GETS:
+        return None
+
+    return {entry["id"]: index_subnet(get_subnet(entry["id"])) for entry in listed}
@@ -0,0 +1,57 @@
+import json
+import os
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class TargetsFile:
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+
+    def changed(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except FileNotFoundError:
+            return False
+
+    def read(self):
+        # remember the modification time before reading, so that a concurrent
+        # write is picked up on the next check, but an invalid file is not
+        # read again until it changes
+        self.mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path) as fd:
+            if self.path.endswith((".yml", ".yaml")):
+                if yaml is None:
+                    raise ValueError(f"Reading {self.path} requires PyYAML")
+                try:
+                    data = yaml.safe_load(fd)
+                except yaml.YAMLError as ex:
+                    raise ValueError(f"Invalid YAML in {self.path}: {ex}") from ex
+            else:
+                data = json.load(fd)
+
+        return parse_targets(data)
+
+
+def parse_targets(data):
+    # Accepts the Prometheus file_sd format, a list of groups with a list of
+    # targets each, as well as a plain list of targets. Labels are ignored.
+    if data is None:
+        return []
+    if not isinstance(data, list):
+        raise TypeError("Targets file must contain a list")
+
+    targets = []
+    for item in data:
+        if isinstance(item, str):
+            targets.append(item)
+        elif isinstance(item, dict) and isinstance(item.get("targets", []), list):
+            targets.extend(str(target) for target in item.get("targets", []))
+        else:
+            raise TypeError(f"Invalid entry in targets file: {item!r}")
+
+    return targets
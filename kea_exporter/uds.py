@@ -1,65 +1,181 @@
 import json
 import os
 import socket
-import sys
-
-import click
+import time
 
 from kea_exporter import DHCPVersion
+from kea_exporter.decoder import BUFFER_SIZE, ResponseBuffer, StatisticsDecoder
+from kea_exporter.instrumentation import PHASE_DURATION, RESPONSE_SIZE, SUBNETS
+from kea_exporter.subnets import (
+    RESULT_EMPTY,
+    RESULT_UNSUPPORTED,
+    index_config,
+    merge_subnet_list,
+    subnet_cmds_version,
+    subnet_family,
+    subnet_list_cheaper,
+)
+
+
+class CommandError(ValueError):
+    def __init__(self, text, result):
+        super().__init__(text)
+        self.result = result
 
 
 class KeaSocketClient:
-    def __init__(self, sock_path, **kwargs):
+    def __init__(self, sock_path, config_max_age=0, timeout=None, connect_timeout=None, max_response_size=0, **kwargs):
         super().__init__()
 
-        if not os.access(sock_path, os.F_OK):
-            raise FileNotFoundError(f"Unix domain socket does not exist at {sock_path}")
-        if not os.access(sock_path, os.R_OK | os.W_OK):
-            raise PermissionError(f"No read/write permissions on Unix domain socket at {sock_path}")
-
         self.sock_path = os.path.abspath(sock_path)
+        self.name = sock_path
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout or timeout
+        self.max_response_size = int(max_response_size * 1024 * 1024)
+        self.buffer = ResponseBuffer(self.max_response_size)
 
         self.version = None
-        self.config = None
         self.subnets = None
         self.subnet_missing_info_sent = []
         self.dhcp_version = None
 
-    def query(self, command):
+        self.config_max_age = config_max_age
+        self.config_hash = None
+        self.config_hash_supported = True
+        self.config_loaded_at = None
+
+        # whether the subnet_cmds hook is loaded, detected on the first reload
+        self.subnet_cmds = None
+
+    def check_socket(self):
+        if not os.access(self.sock_path, os.F_OK):
+            raise FileNotFoundError(f"Unix domain socket does not exist at {self.sock_path}")
+        if not os.access(self.sock_path, os.R_OK | os.W_OK):
+            raise PermissionError(f"No read/write permissions on Unix domain socket at {self.sock_path}")
+
+    def query(self, command, decoder=None, **kwargs):
         with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.connect_timeout)
             sock.connect(self.sock_path)
-            sock.send(bytes(json.dumps({"command": command}), "utf-8"))
-            response = json.loads(sock.makefile().read(-1))
-
-        if response["result"] != 0:
-            raise ValueError
+            sock.settimeout(self.timeout)
+            sock.send(bytes(json.dumps({"command": command, **kwargs}), "utf-8"))
+            if decoder is None:
+                try:
+                    while self.buffer.recv_into(sock):
+                        pass
+                except BaseException:
+                    self.buffer.clear()
+                    raise
+                RESPONSE_SIZE.labels(self.name, command).observe(self.buffer.size)
+                response = self.buffer.decode()
+            else:
+                # decode the response while it is being received
+                with memoryview(self.buffer.buffer)[:BUFFER_SIZE] as chunk:
+                    while True:
+                        received = sock.recv_into(chunk)
+                        if not received:
+                            break
+                        decoder.feed(chunk[:received])
+                response = decoder.close()
+                RESPONSE_SIZE.labels(self.name, command).observe(decoder.size)
+
+        if response["result"] not in (0, RESULT_EMPTY):
+            raise CommandError(response.get("text"), response["result"])
 
         return response
 
-    def stats(self):
-        # I don't currently know how to detect a changed configuration, so
-        # unfortunately we're reloading more often now as a workaround.
-        self.reload()
+    def get_config_hash(self):
+        if not self.config_hash_supported:
+            return None
+
+        try:
+            return self.query("config-hash-get")["arguments"]["hash"]
+        except CommandError as ex:
+            # config-hash-get is only available since Kea 2.4.0, other
+            # errors are retried on the next update
+            if ex.result == RESULT_UNSUPPORTED:
+                self.config_hash_supported = False
+            return None
+        except (ValueError, KeyError):
+            return None
+
+    def config_changed(self, config_hash):
+        if self.subnets is None:
+            return True
+        if config_hash is not None:
+            return config_hash != self.config_hash
+        if self.config_hash_supported:
+            # the hash could not be queried this time
+            return True
+        return time.monotonic() - self.config_loaded_at >= self.config_max_age
 
-        arguments = self.query("statistic-get-all").get("arguments", {})
+    def stats(self):
+        # Only reload the configuration when its hash changed, or when it
+        # exceeded its maximum age on Kea versions without config-hash-get.
+        with PHASE_DURATION.labels(self.name, "config").time():
+            # the socket may not exist yet when the exporter started before Kea
+            if self.subnets is None:
+                self.check_socket()
+            config_hash = self.get_config_hash()
+            if self.config_changed(config_hash):
+                self.reload(config_hash)
+                self.config_hash = config_hash
+
+        start_time = time.perf_counter()
+        decoder = StatisticsDecoder(self.max_response_size)
+        arguments = self.query("statistic-get-all", decoder).get("arguments", {})
+        PHASE_DURATION.labels(self.name, "statistics").observe(time.perf_counter() - start_time - decoder.duration)
+        PHASE_DURATION.labels(self.name, "decode").observe(decoder.duration)
 
         yield self.dhcp_version, arguments, self.subnets
 
-    def reload(self):
-        self.config = self.query("config-get")["arguments"]
+    def detect_subnet_cmds(self):
+        try:
+            dhcp_version = subnet_cmds_version(self.query("list-commands").get("arguments", []))
+        except ValueError:
+            dhcp_version = None
+
+        if dhcp_version is None:
+            return False
 
-        if "Dhcp4" in self.config:
+        self.dhcp_version = dhcp_version
+        return True
+
+    def reload(self, config_hash=None):
+        if self.subnet_cmds is None:
+            self.subnet_cmds = self.detect_subnet_cmds()
+
+        if not self.subnet_cmds or not subnet_list_cheaper(self.subnets, config_hash) or not self.reload_subnet_list():
+            self.reload_config()
+
+        self.config_loaded_at = time.monotonic()
+        SUBNETS.labels(self.name, self.dhcp_version.name.lower()).set(len(self.subnets))
+
+    def reload_subnet_list(self):
+        # subnet_cmds avoids transferring host reservations and options
+        family = subnet_family(self.dhcp_version)
+        listed = self.query(f"{family}-list").get("arguments", {}).get("subnets", [])
+
+        def get_subnet(subnet_id):
+            return self.query(f"{family}-get", arguments={"id": subnet_id})["arguments"][family][0]
+
+        subnets = merge_subnet_list(listed, get_subnet)
+        if subnets is None:
+            return False
+
+        self.subnets = subnets
+        return True
+
+    def reload_config(self):
+        config = self.query("config-get")["arguments"]
+
+        if "Dhcp4" in config:
             self.dhcp_version = DHCPVersion.DHCP4
-            subnets = self.config["Dhcp4"]["subnet4"]
-        elif "Dhcp6" in self.config:
+        elif "Dhcp6" in config:
             self.dhcp_version = DHCPVersion.DHCP6
-            subnets = self.config["Dhcp6"]["subnet6"]
         else:
-            click.echo(
-                f"Socket {self.sock_path} has no supported configuration",
-                file=sys.stderr,
-            )
-            sys.exit(1)
-
-        # create subnet map
-        self.subnets = {subnet["id"]: subnet for subnet in subnets}
+            # fails this target only, the update runs in a worker thread
+            raise ValueError(f"Socket {self.sock_path} has no supported configuration")
+
+        # create subnet map, the configuration itself is not kept
+        self.subnets = index_config(config, self.dhcp_version)
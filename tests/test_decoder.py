@@ -0,0 +1,74 @@
+import json
+import random
+
+import pytest
+
+from kea_exporter.decoder import StatisticsDecoder
+
+TIMESTAMP = "2024-05-01 12:00:00.123456"
+
+RESPONSES = [
+    {
+        "result": 0,
+        "arguments": {
+            "pkt4-received": [[12345, TIMESTAMP], [12344, TIMESTAMP], [12343, TIMESTAMP]],
+            "subnet[1].assigned-addresses": [[-1, TIMESTAMP]],
+            "subnet[1].pool[0].total-addresses": [[18446744073709551615, TIMESTAMP]],
+            "reclaimed-leases": [],
+        },
+    },
+    {
+        "arguments": {
+            "string-sample": [["s]x", TIMESTAMP], ["[y", TIMESTAMP]],
+            "escaped-sample": [['a\\"]b', TIMESTAMP], ["\\\\", TIMESTAMP]],
+            "unicode-sample": [["größe ✓", TIMESTAMP], ["✓]", TIMESTAMP]],
+            "float-sample": [[1.5e3, TIMESTAMP], [0.25, TIMESTAMP]],
+            "nested-sample": [[[1, [2]], TIMESTAMP], [{"a": "]"}, TIMESTAMP]],
+            'key-with-"quote"': [[1, TIMESTAMP]],
+        },
+        "result": 0,
+        "text": "stats ]} [",
+    },
+    [
+        {"result": 0, "arguments": {"pkt6-received": [[7, TIMESTAMP], ["x]", TIMESTAMP]]}},
+        {"result": 1, "text": "Unable to forward command to the dhcp4 service"},
+    ],
+    {"result": 0, "arguments": {}},
+]
+
+
+def newest_samples(response):
+    # the decoder only keeps the newest sample of every statistic
+    if isinstance(response, list):
+        return [newest_samples(item) for item in response]
+    if "arguments" not in response:
+        return response
+    return {**response, "arguments": {key: samples[:1] for key, samples in response["arguments"].items()}}
+
+
+def decode(data, rng, max_size):
+    decoder = StatisticsDecoder()
+    offset = 0
+    while offset < len(data):
+        size = rng.randint(1, max_size)
+        decoder.feed(data[offset : offset + size])
+        offset += size
+    return decoder.close()
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+@pytest.mark.parametrize("response", RESPONSES)
+def test_random_chunks(response, indent):
+    data = json.dumps(response, indent=indent, ensure_ascii=False).encode()
+    expected = newest_samples(json.loads(data))
+    rng = random.Random(len(data))
+    for max_size in (1, 3, 16, 256, len(data)):
+        for _ in range(20):
+            assert decode(data, rng, max_size) == expected
+
+
+def test_incomplete_response():
+    decoder = StatisticsDecoder()
+    decoder.feed(json.dumps(RESPONSES[0]).encode()[:-5])
+    with pytest.raises(ValueError):
+        decoder.close()